@@ -1,8 +1,17 @@
-import requests
-import pandas as pd
-import numpy as np
-import datetime as dt
+import logging
+import time
 from enum import Enum
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from response_cache import ResponseCache
+from json_stream import decode_stream
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# rate limited, server errors and 474 (terminal disconnected from the data servers), anything else won't change on retry
+TRANSIENT_STATUS = {429, 474, 500, 502, 503, 504}
 
 
 class Security(Enum):
@@ -22,16 +31,94 @@ class Right(Enum):
 
 
 class ThetaDataAPI:
-    def __init__(self):
+    def __init__(self, cache: ResponseCache=None, max_in_flight: int=4, max_retries: int=3, backoff: float=0.5):
+        """
+        Arguments:
+        cache: on-disk cache for historical responses, pass ResponseCache(enabled=False) to bypass
+        max_in_flight: maximum number of concurrent requests to the terminal (also the connection pool size)
+        max_retries: number of retries on a transient status (see TRANSIENT_STATUS) or connection error
+        backoff: base delay in seconds, doubled after every retry
+        """
+        import requests
         self.base_url = 'http://127.0.0.1:25510/'
+        self.cache = cache if cache is not None else ResponseCache()
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_all(self, calls: list[tuple[Callable, dict]]) -> list:
+        """
+        Runs API calls concurrently, at most max_in_flight at a time.
+
+        Arguments:
+        calls: list of (method, kwargs) pairs, e.g. (self.get_hist_quotes, {"root": "SPY", ...})
 
-    def _get_req(self, url: str, headers: dict, params: dict=None):
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Request failed with status code {response.status_code}")
-            print(response.text)
+        Returns:
+        list of responses in the same order as calls
+        """
+        if len(calls) <= 1 or self.max_in_flight <= 1:
+            return [method(**kwargs) for method, kwargs in calls]
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            return list(executor.map(lambda call: call[0](**call[1]), calls))
+
+    def _get_req(self, url: str, headers: dict, params: dict=None, stream: bool=False):
+        """
+        Arguments:
+        stream: decode the body incrementally into NumPy columns (see json_stream.decode_stream) instead of JSON lists
+        """
+        from requests.exceptions import ConnectionError as RequestsConnectionError
+        endpoint = url[len(self.base_url):] if url.startswith(self.base_url) else url
+        # metrics label without the query string
+        path = endpoint.split("?", 1)[0]
+        metrics = get_metrics()
+        key = None
+        if self.cache.enabled and ResponseCache.cacheable(endpoint, params):
+            key = ResponseCache.key(f"{endpoint}|stream" if stream else endpoint, params)
+            cached = self.cache.get(key)
+            if cached is not None:
+                metrics.inc("thetadata_cache_hits_total", endpoint=path)
+                return cached
+            metrics.inc("thetadata_cache_misses_total", endpoint=path)
+        with metrics.timer("thetadata_request_seconds", endpoint=path):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = self.session.get(url, headers=headers, params=params, stream=stream)
+                except RequestsConnectionError:
+                    metrics.inc("thetadata_retries_total", endpoint=path, reason="connection")
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self.backoff * 2**attempt)
+                    continue
+                if response.status_code not in TRANSIENT_STATUS or attempt == self.max_retries:
+                    break
+                metrics.inc("thetadata_retries_total", endpoint=path, reason=str(response.status_code))
+                # hand the connection back to the pool, a streamed body is never read otherwise
+                response.close()
+                time.sleep(self.backoff * 2**attempt)
+            if response.status_code == 200:
+                if stream:
+                    content_length = response.headers.get('Content-Length')
+                    data = decode_stream(self._count_bytes(response.iter_content(chunk_size=1 << 16), path), content_length=int(content_length) if content_length else None)
+                else:
+                    metrics.inc("thetadata_response_bytes_total", len(response.content), endpoint=path)
+                    data = response.json()
+                if key is not None and data.get("header", {}).get("error_type") in (None, "null"):
+                    self.cache.put(key, data)
+                return data
+        metrics.inc("thetadata_failures_total", endpoint=path, status=str(response.status_code))
+        logger.warning("request to %s failed with status code %s: %s", path, response.status_code, response.text)
+        response.close()
+
+    @staticmethod
+    def _count_bytes(chunks, path: str):
+        metrics = get_metrics()
+        for chunk in chunks:
+            metrics.inc("thetadata_response_bytes_total", len(chunk), endpoint=path)
+            yield chunk
 
     def get_roots(self, security_type: Security=Security.OPTION):
         url = f'{self.base_url}list/roots?sec={security_type.value}'
@@ -75,28 +162,28 @@ class ThetaDataAPI:
         elif security_type == Security.OPTION:
             url = f'{self.base_url}hist/{security_type.value}/eod?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}'
         headers = {'Accept': 'application/json'}
-        print(url)
+        logger.debug("GET %s", url)
         return self._get_req(url=url, headers=headers)
 
-    def get_hist_quotes(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str=None):
+    def get_hist_quotes(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str=None, stream: bool=False):
         url = f'{self.base_url}hist/option/quote?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}&ivl={0 if ivl is None else ivl}'
         headers = {'Accept': 'application/json'}
-        return self._get_req(url=url, headers=headers)
+        return self._get_req(url=url, headers=headers, stream=stream)
 
-    def get_ohlc(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str):
+    def get_ohlc(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str, stream: bool=False):
         url = f'{self.base_url}hist/option/ohlc?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}&ivl={ivl}'
         headers = {'Accept': 'application/json'}
-        return self._get_req(url=url, headers=headers)
+        return self._get_req(url=url, headers=headers, stream=stream)
     
     def get_hist_oi(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str):
         url = f'{self.base_url}hist/option/open_interest?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}&ivl={ivl}'
         headers = {'Accept': 'application/json'}
         return self._get_req(url=url, headers=headers)
     
-    def get_hist_trades(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right):
+    def get_hist_trades(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, stream: bool=False):
         url = f'{self.base_url}hist/option/trade?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}'
         headers = {'Accept': 'application/json'}
-        return self._get_req(url=url, headers=headers)
+        return self._get_req(url=url, headers=headers, stream=stream)
     
     def get_hist_iv(self, root: str, start_date: str, end_date: str, exp: str, strike: str, right: Right, ivl: str):
         url = f'{self.base_url}hist/option/implied_volatility?root={root}&start_date={start_date}&end_date={end_date}&strike={strike}&exp={exp}&right={right.value}&ivl={ivl}'
@@ -108,7 +195,27 @@ class ThetaDataAPI:
         headers = {'Accept': 'application/json'}
         return self._get_req(url=url, headers=headers)
     
-    def get_eod_greeks(self, root: str, exp: str, start_date: str, end_date: str):
+    def get_eod_greeks(self, root: str, exp: str, start_date: str, end_date: str, stream: bool=False):
         url = f'{self.base_url}bulk_hist/option/eod_trade_greeks?root={root}&exp={exp}&start_date={start_date}&end_date={end_date}'
         headers = {'Accept': 'application/json'}
-        return self._get_req(url=url, headers=headers)
\ No newline at end of file
+        return self._get_req(url=url, headers=headers, stream=stream)
+
+    def get_bulk_hist_quotes(self, root: str, exp: str, start_date: str, end_date: str, ivl: str=None, stream: bool=False):
+        url = f'{self.base_url}bulk_hist/option/quote?root={root}&exp={exp}&start_date={start_date}&end_date={end_date}&ivl={0 if ivl is None else ivl}'
+        headers = {'Accept': 'application/json'}
+        return self._get_req(url=url, headers=headers, stream=stream)
+
+    def get_bulk_eod(self, root: str, exp: str, start_date: str, end_date: str, stream: bool=False):
+        url = f'{self.base_url}bulk_hist/option/eod?root={root}&exp={exp}&start_date={start_date}&end_date={end_date}'
+        headers = {'Accept': 'application/json'}
+        return self._get_req(url=url, headers=headers, stream=stream)
+
+    def get_bulk_ohlc(self, root: str, exp: str, start_date: str, end_date: str, ivl: str, stream: bool=False):
+        url = f'{self.base_url}bulk_hist/option/ohlc?root={root}&exp={exp}&start_date={start_date}&end_date={end_date}&ivl={ivl}'
+        headers = {'Accept': 'application/json'}
+        return self._get_req(url=url, headers=headers, stream=stream)
+
+    def get_bulk_hist_oi(self, root: str, exp: str, start_date: str, end_date: str, stream: bool=False):
+        url = f'{self.base_url}bulk_hist/option/open_interest?root={root}&exp={exp}&start_date={start_date}&end_date={end_date}'
+        headers = {'Accept': 'application/json'}
+        return self._get_req(url=url, headers=headers, stream=stream)
@@ -1,20 +1,20 @@
 import numpy as np
-from datetime import datetime as dt
 
 from ThetaDataClient import ThetaDataAPI, Security, Right
+from response_cache import ResponseCache
+from option_chain import OptionChain
+from metrics import get_metrics
 
 class WrapperClient:
-    def __init__(self):
-        self.thetadata = ThetaDataAPI()
-        self.date_format = "%Y%m%d"
+    def __init__(self, cache: ResponseCache=None, max_in_flight: int=4):
+        self.thetadata = ThetaDataAPI(cache=cache, max_in_flight=max_in_flight)
 
     def get_dates_in_range(self, root: str, exp: str, start_date: str, end_date: str):
         dates = self.thetadata.get_dates(root=root, exp=exp)["response"]
         start = start_date if start_date is not None else dates[0]
         end = end_date if end_date is not None else dates[len(dates)-1]
-        start_datetime = dt.strptime(str(start), self.date_format)
-        end_datetime = dt.strptime(str(end), self.date_format)
-        dates = [date for date in dates if start_datetime <= dt.strptime(str(date), self.date_format) <= end_datetime]
+        # YYYYMMDD ints sort like the dates themselves
+        dates = [date for date in dates if int(start) <= int(date) <= int(end)]
         return (start, end, dates)
     
     def get_underlying_over_time(self, root: str, security_type: Security, points, dates: list[str]):
@@ -23,8 +23,9 @@ class WrapperClient:
         for point in points:
             prices[point] = [None] * num_days
         data_points = {}
+        responses = self.thetadata.fetch_all([(self.thetadata.get_eod_prices, dict(root=root, security_type=security_type, start_date=date, end_date=date)) for date in dates])
         for i in range(num_days):
-            eod_prices = self.thetadata.get_eod_prices(root=root, security_type=security_type, start_date=dates[i], end_date=dates[i])
+            eod_prices = responses[i]
             header = eod_prices["header"]
             response = eod_prices["response"]
             if not data_points:
@@ -34,59 +35,83 @@ class WrapperClient:
                 prices[point][i] = response[0][index]
         return prices
 
-    def get_chains_over_time(self, root: str, exp: str, right: Right, points: list[str], start_date: str=None, end_date: str=None):
-        start, end, dates = self.get_dates_in_range(root=root, exp=exp, start_date=start_date, end_date=end_date)
-        num_days = len(dates)
-        strikes = self.thetadata.get_strikes(root=root, exp=exp)["response"]
-        num_strikes = len(strikes)
-        data = {}
-        for point in points:
-            data[point] = []
-        data_points = {}
-        valid_strikes = []
-        for i in range(num_strikes):
-            eod_prices = self.thetadata.get_hist_quotes(root=root, start_date=start, end_date=end, exp=exp, strike=strikes[i], right=right)
-            header = eod_prices["header"]
-            if header["error_type"] != "null":
-                continue
-            response = eod_prices["response"]
-            if len(response) > num_days or len(response) < num_days:
-                if len(response) > num_days:
-                    print(response)
-                continue
-            valid_strikes.append(strikes[i])
-            if not data_points:
-                for point in points:
-                    data_points[point] = header["format"].index(point)
-            for point, index in data_points.items():
-                data[point].append([d[index] for d in response])
-        for point in points:
-            data[point] = np.column_stack(data[point])
-        print(data)
-        return (dates, valid_strikes, data)
+    def assemble_bulk(self, bulk: dict, dates: list, points: list[str]):
+        """
+        Converts a streamed bulk_hist response (see json_stream.decode_stream) into dense (dates x strikes) arrays per right.
 
+        Days a strike wasn't quoted are left as NaN instead of dropping the strike. If a contract has more than one
+        tick per day the last one is kept.
 
-    # Need to address blanks in data
-    def get_greeks_chains_over_time(self, root: str, exp: str, points: list[str], start_date: str=None, end_date: str=None):
-        start, end, dates = self.get_dates_in_range(root=root, exp=exp, start_date=start_date, end_date=end_date)
-        num_days = len(dates)
-        eod_greeks = cached_eod_greeks #self.thetadata.get_eod_greeks(root=root, start_date=start, end_date=end, exp=exp)
-        header = eod_greeks["header"]
-        response = eod_greeks["response"]
-        data_points = {}
-        calls = {}
-        puts = {}
-        for point in points:
-            data_points[point] = header["format"].index(point)
-            calls[point] = {}
-            puts[point] = {}
-        for eod in response:
-            contract = eod["contract"]
-            ticks = eod["ticks"]
-            for point, index in data_points.items():
-                (calls if contract["right"] == "C" else puts)[point][contract["strike"]] = [d[index] for d in ticks]
-        for point in points:
-            print(list(calls[point].values()))
-            # calls[point] = {k: v for k, v in calls[point].items() if len(v)==num_days}
-            # calls[point] = (calls[point].keys(), np.column_stack(list(calls[point].values())))
-        return (calls, puts)
+        Returns:
+        dict mapping Right to (strikes, {point: np.ndarray of shape (len(dates), len(strikes))})
+        """
+        dates = np.asarray(dates, dtype=np.int64)
+        if bulk["header"].get("error_type") not in (None, "null") or not bulk.get("contracts") or dates.size == 0:
+            return {right: ([], {point: np.full((dates.size, 0), np.nan) for point in points}) for right in Right}
+        contracts = bulk["contracts"]
+        ticks = bulk["response"]
+        num_ticks = np.diff(bulk["offsets"])
+        # per tick: owning contract, row in dates, and whether it is the last tick of that contract on that day
+        contract_of_tick = np.repeat(np.arange(len(contracts)), num_ticks)
+        tick_dates = ticks["date"].astype(np.int64)
+        rows = np.minimum(np.searchsorted(dates, tick_dates), dates.size - 1)
+        keep = dates[rows] == tick_dates
+        day_key = np.where(keep, contract_of_tick * dates.size + rows, -1 - np.arange(rows.size))
+        keep[:-1] &= day_key[1:] != day_key[:-1]
+        contract_strikes = np.array([contract["strike"] for contract in contracts])
+        contract_rights = np.array([contract["right"] for contract in contracts])
+        chains = {}
+        for right in Right:
+            is_right = contract_rights == right.value
+            strikes = np.unique(contract_strikes[is_right & (num_ticks > 0)])
+            mask = keep & is_right[contract_of_tick]
+            cols = np.searchsorted(strikes, contract_strikes[contract_of_tick[mask]])
+            data = {}
+            for point in points:
+                data[point] = np.full((dates.size, strikes.size), np.nan)
+                data[point][rows[mask], cols] = ticks[point][mask]
+            chains[right] = (strikes.tolist(), data)
+        return chains
+
+    def to_chain(self, root: str, exp: str, dates: list, bulk: dict, points: list[str], right: Right=None) -> OptionChain:
+        """
+        Assembles a bulk response into an OptionChain (dollar strikes, days since epoch), optionally for one right only
+        """
+        chains = self.assemble_bulk(bulk=bulk, dates=dates, points=points)
+        if right is not None:
+            chains = {right: chains[right]}
+        return OptionChain.from_bulk(root=root, exp=exp, dates=dates, chains=chains, points=points)
+
+    def get_chains_over_time(self, root: str, exp: str, right: Right, points: list[str], start_date: str=None, end_date: str=None, ivl: int=None) -> OptionChain:
+        """
+        Gets quotes for every strike of an expiration in a single bulk request.
+
+        Arguments:
+        right: Right to keep, None for both
+
+        Returns:
+        OptionChain with one expiration, NaN on days a strike wasn't quoted
+        """
+        with get_metrics().timer("stage_seconds", stage="fetch"):
+            start, end, dates = self.get_dates_in_range(root=root, exp=exp, start_date=start_date, end_date=end_date)
+            bulk = self.thetadata.get_bulk_hist_quotes(root=root, exp=exp, start_date=start, end_date=end, ivl=ivl, stream=True)
+        return self.to_chain(root=root, exp=exp, dates=dates, bulk=bulk, points=points, right=right)
+
+    def get_eod_chains_over_time(self, root: str, exp: str, right: Right, points: list[str], start_date: str=None, end_date: str=None) -> OptionChain:
+        """
+        Same as get_chains_over_time using end of day reports
+        """
+        with get_metrics().timer("stage_seconds", stage="fetch"):
+            start, end, dates = self.get_dates_in_range(root=root, exp=exp, start_date=start_date, end_date=end_date)
+            bulk = self.thetadata.get_bulk_eod(root=root, exp=exp, start_date=start, end_date=end, stream=True)
+        return self.to_chain(root=root, exp=exp, dates=dates, bulk=bulk, points=points, right=right)
+
+    def get_greeks_chains_over_time(self, root: str, exp: str, points: list[str], start_date: str=None, end_date: str=None) -> OptionChain:
+        """
+        Returns:
+        OptionChain of EOD greeks for both rights of one expiration
+        """
+        with get_metrics().timer("stage_seconds", stage="fetch"):
+            start, end, dates = self.get_dates_in_range(root=root, exp=exp, start_date=start_date, end_date=end_date)
+            eod_greeks = self.thetadata.get_eod_greeks(root=root, start_date=start, end_date=end, exp=exp, stream=True)
+        return self.to_chain(root=root, exp=exp, dates=dates, bulk=eod_greeks, points=points)
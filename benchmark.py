@@ -0,0 +1,385 @@
+"""
+Offline benchmarks for the pricing, IV, density and data-loading hot paths.
+
+Everything runs on synthetic chains and returns, and WrapperClient talks to a local mock terminal that replays canned
+JSON, so no ThetaData terminal or network access is needed. Results are stored per git commit so runs can be compared:
+
+    python benchmark.py                    # run and store under the current commit
+    python benchmark.py --compare HEAD~1   # also report timings that got slower than HEAD~1's
+    python benchmark.py --startup-only     # only check import times against STARTUP_BUDGET
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_PATH = os.path.join(REPO_DIR, ".benchmarks", "results.json")
+# (dates, strikes) per chain size
+SIZES = {"small": (10, 50), "medium": (60, 200), "large": (250, 400)}
+# (dates, strikes, ticks per contract and day) of the intraday (ivl=60000) data-loading benchmark
+INTRADAY_SIZE = (10, 20, 390)
+QUOTE_FORMAT = ["ms_of_day", "bid_size", "bid_exchange", "bid", "bid_condition", "ask_size", "ask_exchange", "ask", "ask_condition", "date"]
+EXP = 20231215
+# seconds a cold `import module` may take, checked on every run
+STARTUP_BUDGET = {"black_scholes": 0.2}
+STARTUP_MODULES = ["black_scholes", "option_chain", "ThetaDataClient", "WrapperClient", "model", "engine", "distribution", "svi"]
+# imported on demand only, none of these should be loaded by a bare import of the modules above
+HEAVY_MODULES = ["matplotlib", "yfinance", "sklearn", "scipy.stats", "scipy.integrate", "scipy.optimize", "requests"]
+STARTUP_SCRIPT = """
+import socket, sys, time, json
+def blocked(*args, **kwargs):
+    raise RuntimeError("network access during import")
+socket.socket.connect = blocked
+socket.create_connection = blocked
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def synthetic_dates(num_dates: int) -> list[int]:
+    days = pd.bdate_range(end="2023-12-14", periods=num_dates)
+    return [int(day.strftime("%Y%m%d")) for day in days]
+
+def synthetic_chain(num_dates: int, num_strikes: int, spot: float=100.0, seed: int=0) -> dict:
+    """
+    Smile-shaped bid/ask quotes for one expiration
+
+    Returns:
+    dict with dates (YYYYMMDD), strikes (dollars), t (years, per date), spot, iv and bid/ask per right, each (dates x strikes)
+    """
+    from black_scholes import black_scholes_call, black_scholes_put
+    rng = np.random.default_rng(seed)
+    dates = synthetic_dates(num_dates)
+    strikes = np.linspace(0.7 * spot, 1.3 * spot, num_strikes).round(2)
+    days = pd.to_datetime([str(date) for date in dates])
+    t = ((pd.Timestamp(str(EXP)) - days).days.values + 1) / 365
+    iv = 0.2 + 0.3 * (np.log(strikes / spot)[None, :]) ** 2 + 0.05 * (-np.log(strikes / spot)[None, :]) + 0.01 * rng.standard_normal((num_dates, 1))
+    chain = {"dates": dates, "strikes": strikes, "t": t, "spot": spot, "iv": iv}
+    for right, price in (("C", black_scholes_call), ("P", black_scholes_put)):
+        mid = price(spot, strikes[None, :], iv, t[:, None], 0)
+        half_spread = np.maximum(0.005 * mid, 0.01)
+        chain[right] = (np.maximum(mid - half_spread, 0), mid + half_spread)
+    return chain
+
+def synthetic_returns(num_days: int=5000, seed: int=0) -> pd.Series:
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range(end="2023-12-14", periods=num_days)
+    return pd.Series(0.01 * rng.standard_t(4, num_days) / np.sqrt(2), index=index)
+
+def synthetic_vix(index: pd.DatetimeIndex, seed: int=0) -> pd.Series:
+    # mean-reverting log VIX around 18
+    rng = np.random.default_rng(seed)
+    log_vix = np.empty(index.size)
+    log_vix[0] = np.log(18)
+    for i in range(1, index.size):
+        log_vix[i] = log_vix[i - 1] + 0.05 * (np.log(18) - log_vix[i - 1]) + 0.08 * rng.standard_normal()
+    return pd.Series(np.exp(log_vix), index=index)
+
+
+class MockTerminal:
+    def __init__(self, responses: dict):
+        """
+        Local stand-in for the ThetaData terminal serving canned JSON on a free port.
+
+        Arguments:
+        responses: URL path (e.g. "list/dates/option/quote") to a JSON-serializable body
+        """
+        self.responses = {path: json.dumps(body).encode() for path, body in responses.items()}
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = mock.responses.get(urlparse(self.path).path.lstrip("/"))
+                self.send_response(200 if body is not None else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def bulk_quote_response(chain: dict, ticks_per_day: int=1) -> dict:
+    """
+    bulk_hist/option/quote body for the chain with ticks_per_day quotes per contract and day, one a minute up to the
+    16:00 close (like an ivl=60000 request), all at that day's bid/ask
+    """
+    response = []
+    for right in ("C", "P"):
+        bid, ask = chain[right]
+        for j, strike in enumerate(chain["strikes"]):
+            ticks = [[57_600_000 - 60_000 * n, 10, 1, round(float(bid[i, j]), 4), 0, 10, 1, round(float(ask[i, j]), 4), 0, date]
+                     for i, date in enumerate(chain["dates"]) for n in range(ticks_per_day - 1, -1, -1)]
+            response.append({"contract": {"root": "SPY", "expiration": EXP, "strike": int(round(strike * 1000)), "right": right}, "ticks": ticks})
+    return {"header": {"format": QUOTE_FORMAT, "error_type": "null"}, "response": response}
+
+
+def timeit(func, repeat: int=5, min_time: float=0.05) -> dict:
+    """
+    Best and median seconds per call over repeat rounds, each round looping func for at least min_time
+    """
+    func()
+    loops, elapsed = 1, 0.0
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 20:
+            break
+        loops *= 2
+    rounds = [elapsed / loops]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        rounds.append((time.perf_counter() - start) / loops)
+    return {"best": min(rounds), "median": float(np.median(rounds)), "loops": loops}
+
+def bench_bs_iv_bulk(chain: dict):
+    from black_scholes import bs_iv_bulk
+    bid, ask = chain["C"]
+    mid = (bid + ask) / 2
+    return lambda: bs_iv_bulk(mid, chain["strikes"][None, :], chain["spot"], chain["t"][:, None])
+
+def bench_call_theo(chain: dict, returns: pd.Series):
+    from model import Model
+    from model_store import ModelStore
+    model = Model.from_fitted(ModelStore(persist=False).fit(root="SPY", returns=returns))
+    strikes = chain["strikes"]
+    return lambda: [model.call_theo(strike=strike, spot=chain["spot"]) for strike in strikes]
+
+def bench_theos(chain: dict, returns: pd.Series):
+    from model import Model
+    from model_store import ModelStore
+    model = Model.from_fitted(ModelStore(persist=False).fit(root="SPY", returns=returns))
+    strikes = np.broadcast_to(chain["strikes"], chain["iv"].shape)
+    return lambda: model.theos(strikes=strikes, spot=chain["spot"], rights=True)
+
+def bench_pdf_from_IV(chain: dict):
+    from breeden_litzenberger import pdf_from_IV
+    return lambda: pdf_from_IV(chain["strikes"], chain["iv"][0], chain["spot"], chain["t"][0], 0)
+
+def bench_pdf_cube(chain: dict):
+    from breeden_litzenberger import pdf_cube
+    return lambda: pdf_cube(chain["strikes"], chain["iv"][:, None, :], np.full(len(chain["dates"]), chain["spot"]), chain["t"][:, None])
+
+def bench_vix_parametrize(returns: pd.Series, vix: pd.Series):
+    from distribution import vix_parametrize
+    return lambda: vix_parametrize(returns, vix=vix)
+
+def bench_get_chains_over_time(chain: dict, client, ivl: int=None):
+    return lambda: client.get_chains_over_time(root="SPY", exp=EXP, right=None, points=["bid", "ask"], ivl=ivl)
+
+def bench_backtest(chain: dict, engine):
+    from option_chain import OptionChain
+    from dates import datetime_to_days
+    fields = {name: np.stack([chain[right][k] for right in ("C", "P")])[:, None] for k, name in enumerate(("bid", "ask"))}
+    option_chain = OptionChain("SPY", [0, 1], [np.datetime64(pd.Timestamp(str(EXP)).date(), "D").astype(np.int64)],
+        datetime_to_days(pd.to_datetime([str(date) for date in chain["dates"]])), chain["strikes"], fields)
+    rng = np.random.default_rng(0)
+    direction = rng.choice([-1, 0, 0, 1], size=option_chain.shape)
+    return lambda: engine.run_chain(option_chain, direction)
+
+def startup_times(modules: list[str], repeat: int=5) -> dict:
+    """
+    Best wall time of importing each module in a fresh interpreter with sockets disabled, and which heavy optional
+    modules the import pulled in
+    """
+    results = {}
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            script = STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+            output = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True)
+            if output.returncode != 0:
+                raise RuntimeError(f"importing {module} failed:\n{output.stderr}")
+            runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        seconds = [run["seconds"] for run in runs]
+        results[f"import[{module}]"] = {"best": min(seconds), "median": float(np.median(seconds)), "loops": 1, "heavy": runs[0]["heavy"]}
+    return results
+
+def check_startup(results: dict) -> list[str]:
+    """
+    Returns:
+    descriptions of imports over STARTUP_BUDGET or pulling in HEAVY_MODULES
+    """
+    failures = []
+    for module, budget in STARTUP_BUDGET.items():
+        timing = results.get(f"import[{module}]")
+        if timing is not None and timing["best"] > budget:
+            failures.append(f"import {module} took {timing['best'] * 1e3:.0f}ms, budget {budget * 1e3:.0f}ms")
+    for name, timing in results.items():
+        if name.startswith("import[") and timing.get("heavy"):
+            failures.append(f"{name[len('import['):-1]} imports {', '.join(timing['heavy'])}")
+    return failures
+
+def check_decode(chunk_sizes: tuple=(1, 7, 4096, 1 << 16), ticks_per_day: tuple=(0, 1, 390)) -> list[str]:
+    """
+    Compares json_stream.decode_stream with json.loads on bulk bodies split into chunks of every size in chunk_sizes
+
+    Returns:
+    descriptions of mismatches
+    """
+    from json_stream import decode_stream
+    failures = []
+    chain = synthetic_chain(2, 4)
+    for num_ticks in ticks_per_day:
+        body = bulk_quote_response(chain, ticks_per_day=num_ticks)
+        raw = json.dumps(body).encode()
+        expected = json.loads(raw)["response"]
+        ticks = np.array([tick for element in expected for tick in element["ticks"]], dtype=np.float64).reshape(-1, len(QUOTE_FORMAT))
+        for chunk_size in chunk_sizes:
+            decoded = decode_stream((raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)), content_length=len(raw))
+            same = decoded["contracts"] == [element["contract"] for element in expected]
+            same &= np.diff(decoded["offsets"]).tolist() == [len(element["ticks"]) for element in expected]
+            same &= all(np.array_equal(decoded["response"][name], ticks[:, k]) for k, name in enumerate(QUOTE_FORMAT))
+            if not same:
+                failures.append(f"{num_ticks} ticks per contract and day in {chunk_size} byte chunks differs from json.loads")
+    return failures
+
+def run_benchmarks(sizes: list[str]) -> dict:
+    from market_data import MarketDataStore, _dtype
+    from WrapperClient import WrapperClient
+    from response_cache import ResponseCache
+    from engine import Engine
+    from dates import datetime_to_days
+
+    returns = synthetic_returns()
+    vix = synthetic_vix(returns.index)
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        closes = np.empty(returns.size, dtype=_dtype)
+        closes["date"] = datetime_to_days(returns.index)
+        closes["close"] = 100 * np.exp(np.cumsum(returns.values))
+        market_data = MarketDataStore(data_dir, offline=True)
+        market_data._write("SPY", closes)
+        engine = Engine("SPY", returns.index[0].date(), market_data=market_data)
+        results["vix_parametrize"] = timeit(bench_vix_parametrize(returns, vix))
+        for size in sizes:
+            chain = synthetic_chain(*SIZES[size])
+            responses = {"list/dates/option/quote": {"header": {"format": None, "error_type": "null"}, "response": chain["dates"]}, "bulk_hist/option/quote": bulk_quote_response(chain)}
+            results[f"bs_iv_bulk[{size}]"] = timeit(bench_bs_iv_bulk(chain))
+            results[f"call_theo[{size}]"] = timeit(bench_call_theo(chain, returns), repeat=3)
+            results[f"theos[{size}]"] = timeit(bench_theos(chain, returns))
+            results[f"pdf_from_IV[{size}]"] = timeit(bench_pdf_from_IV(chain))
+            results[f"pdf_cube[{size}]"] = timeit(bench_pdf_cube(chain), repeat=3)
+            results[f"backtest[{size}]"] = timeit(bench_backtest(chain, engine))
+            with MockTerminal(responses) as terminal:
+                client = WrapperClient(cache=ResponseCache(enabled=False))
+                client.thetadata.base_url = terminal.base_url
+                results[f"get_chains_over_time[{size}]"] = timeit(bench_get_chains_over_time(chain, client), repeat=3)
+        # many ticks per contract, each bulk element spans a lot of chunks
+        num_dates, num_strikes, ticks_per_day = INTRADAY_SIZE
+        chain = synthetic_chain(num_dates, num_strikes)
+        responses = {"list/dates/option/quote": {"header": {"format": None, "error_type": "null"}, "response": chain["dates"]}, "bulk_hist/option/quote": bulk_quote_response(chain, ticks_per_day=ticks_per_day)}
+        with MockTerminal(responses) as terminal:
+            client = WrapperClient(cache=ResponseCache(enabled=False))
+            client.thetadata.base_url = terminal.base_url
+            results["get_chains_over_time[ivl]"] = timeit(bench_get_chains_over_time(chain, client, ivl=60_000), repeat=3)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def resolve_commit(ref: str) -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", ref], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ref
+
+def load_results(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_results(path: str, commit: str, results: dict):
+    from file_io import atomic_write
+    history = load_results(path)
+    history[commit] = {"time": time.time(), "python": sys.version.split()[0], "numpy": np.__version__, "results": results}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, "w") as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns:
+    names of benchmarks whose best time is more than threshold (e.g. 0.2 for 20%) slower than the baseline's
+    """
+    regressions = []
+    for name, timing in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = timing["best"] / baseline[name]["best"]
+        flag = "  REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:40s} {baseline[name]['best'] * 1e3:10.3f}ms -> {timing['best'] * 1e3:10.3f}ms  x{ratio:.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--results", default=RESULTS_PATH, help="JSON file results are stored in, keyed by commit")
+    parser.add_argument("--compare", metavar="REF", help="git ref (or stored key) to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--startup-only", action="store_true", help="only measure import times")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    results = startup_times(STARTUP_MODULES)
+    if not args.startup_only:
+        results.update(run_benchmarks(args.sizes))
+    for name, timing in sorted(results.items()):
+        print(f"{name:40s} best {timing['best'] * 1e3:10.3f}ms  median {timing['median'] * 1e3:10.3f}ms")
+    commit = git_commit()
+    if not args.no_save:
+        save_results(args.results, commit, results)
+    failed = False
+    for failure in check_startup(results):
+        print(f"STARTUP: {failure}")
+        failed = True
+    for failure in [] if args.startup_only else check_decode():
+        print(f"DECODE: {failure}")
+        failed = True
+    if args.compare:
+        history = load_results(args.results)
+        key = args.compare if args.compare in history else resolve_commit(args.compare)
+        if key not in history:
+            sys.exit(f"no stored results for {args.compare}")
+        failed |= bool(compare(results, history[key]["results"], args.threshold))
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,27 @@
 import numpy as np
-from scipy.stats import norm
+
+from metrics import get_metrics
+
+GREEKS = ("price", "delta", "gamma", "vega", "theta", "rho")
+INV_SQRT_2PI = 1 / np.sqrt(2 * np.pi)
+
+_scipy_ndtr = None
+
+def ndtr(x):
+    """
+    Standard normal cdf, scipy.special is only imported on first use to keep this module cheap to import
+    """
+    global _scipy_ndtr
+    if _scipy_ndtr is None:
+        from scipy.special import ndtr as scipy_ndtr
+        _scipy_ndtr = scipy_ndtr
+    return _scipy_ndtr(x)
+
+def _d1_d2(S, K, sigma, t, r):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vol_t = sigma * np.sqrt(t)
+        d1 = np.divide(1, vol_t) * (np.log(S/K) + (r+sigma**2 / 2) * t)
+    return (d1, d1 - vol_t)
 
 def black_scholes_call(S: float, K, sigma, t: float, r: float):
     """
@@ -9,10 +31,8 @@ def black_scholes_call(S: float, K, sigma, t: float, r: float):
     r: risk-free interest rate (annual rate, expressed in terms of continuous compounding)
     sigma: volatility of the underlying asset (annual standard deviation of the asset's returns)
     """
-    with np.errstate(divide='ignore'):
-        d1 = np.divide(1, sigma * np.sqrt(t)) * (np.log(S/K) + (r+sigma**2 / 2) * t)
-        d2 = d1 - sigma * np.sqrt(t)
-    return np.multiply(norm.cdf(d1),S) - np.multiply(norm.cdf(d2), K * np.exp(-r * t))
+    d1, d2 = _d1_d2(S, K, sigma, t, r)
+    return np.multiply(ndtr(d1), S) - np.multiply(ndtr(d2), K * np.exp(-r * t))
 
 def black_scholes_put(S: float, K, sigma, t: float, r: float):
     """
@@ -22,15 +42,59 @@ def black_scholes_put(S: float, K, sigma, t: float, r: float):
     r: risk-free interest rate (annual rate, expressed in terms of continuous compounding)
     sigma: volatility of the underlying asset (annual standard deviation of the asset's returns)
     """
-    with np.errstate(divide='ignore'):
-        d1 = np.divide(1, sigma * np.sqrt(t)) * (np.log(S/K) + (r+sigma**2 / 2) * t)
-        d2 = d1 - sigma * np.sqrt(t)
-    return np.multiply(norm.cdf(-d2), K * np.exp(-r * t)) - np.multiply(norm.cdf(-d1),S) 
+    d1, d2 = _d1_d2(S, K, sigma, t, r)
+    return np.multiply(ndtr(-d2), K * np.exp(-r * t)) - np.multiply(ndtr(-d1), S)
 
 def call_vega(S, K, sigma, t=0, r=0):
-    with np.errstate(divide='ignore'):
-        d1 = np.divide(1, sigma * np.sqrt(t)) * (np.log(S/K) + (r+sigma**2 / 2) * t)
-    return np.multiply(S, norm.pdf(d1)) * np.sqrt(t)
+    d1, _ = _d1_d2(S, K, sigma, t, r)
+    return np.multiply(S, np.exp(-d1 * d1 / 2) * INV_SQRT_2PI) * np.sqrt(t)
+
+def bs_price(S, K, sigma, t, r=0, rights=None):
+    """
+    Call or put prices in one pass, rights as in rights_to_mask (defaults to all calls)
+    """
+    d1, d2 = _d1_d2(S, K, sigma, t, r)
+    sign = np.where(rights_to_mask(rights, np.shape(d1)), 1.0, -1.0)
+    return sign * (np.multiply(ndtr(sign * d1), S) - np.multiply(ndtr(sign * d2), K * np.exp(-r * t)))
+
+def bs_greeks(S, K, sigma, t, r=0, rights=None, out: dict=None) -> dict:
+    """
+    Fused Black-Scholes kernel: price, delta, gamma, vega, theta and rho of calls and puts in one pass.
+
+    Inputs broadcast against each other, so e.g. strikes of shape (K,), vols of shape (E, 1) and times of shape (E, 1)
+    price a whole (expiry x strike) surface. Vega and rho are per unit (not per 1%) change, theta is per year.
+
+    Arguments:
+    S: spot price of the underlying asset
+    K: strike prices
+    sigma: volatilities
+    t: time to expiration (in years)
+    r: risk-free interest rate
+    rights: Right enums, 'C'/'P' strings or booleans (True for call); defaults to all calls
+    out: optional dict of preallocated float64 arrays with the broadcast shape, keyed like GREEKS, written in place
+
+    Returns:
+    dict mapping each name in GREEKS to an array
+    """
+    S, K, sigma, t, r = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (S, K, sigma, t, r)))
+    shape = S.shape
+    if out is None:
+        out = {name: np.empty(shape) for name in GREEKS}
+    sign = np.where(rights_to_mask(rights, shape), 1.0, -1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sqrt_t = np.sqrt(t)
+        d1, d2 = _d1_d2(S, K, sigma, t, r)
+        pdf_d1 = np.exp(-d1 * d1 / 2) * INV_SQRT_2PI
+        discounted_K = K * np.exp(-r * t)
+        nd1 = ndtr(sign * d1)
+        nd2 = ndtr(sign * d2)
+        np.multiply(sign, S * nd1 - discounted_K * nd2, out=out["price"])
+        np.multiply(sign, nd1, out=out["delta"])
+        np.divide(pdf_d1, S * sigma * sqrt_t, out=out["gamma"])
+        np.multiply(S * pdf_d1, sqrt_t, out=out["vega"])
+        np.subtract(-S * pdf_d1 * sigma / (2 * sqrt_t), sign * r * discounted_K * nd2, out=out["theta"])
+        np.multiply(sign * t, discounted_K * nd2, out=out["rho"])
+    return out
 
 def bs_iv(price, S, K, t=0, r=0, precision=1e-4, initial_guess=0.2, max_iter=1000, verbose=False):
     iv = initial_guess
@@ -45,9 +109,125 @@ def bs_iv(price, S, K, t=0, r=0, precision=1e-4, initial_guess=0.2, max_iter=100
         print(f"Did not converge after {max_iter} iterations")
     return iv 
 
-def bs_iv_bulk(prices, strikes, S, t=0, r=0):
-    num_contracts = len(strikes)
-    iv = [None] * num_contracts
-    for i in range(num_contracts):
-        iv[i] = bs_iv(price=prices[i], K=strikes[i], S=S, t=t, r=r, max_iter=500)
-    return iv
\ No newline at end of file
+
+def rights_to_mask(rights, shape):
+    """
+    Converts rights (Right enums, 'C'/'P' strings or booleans) into a boolean call mask
+    """
+    if rights is None:
+        return np.ones(shape, dtype=bool)
+    rights = np.asarray(rights)
+    if rights.dtype == bool:
+        return np.broadcast_to(rights, shape)
+    if rights.dtype.kind in "US":
+        return np.broadcast_to(rights == "C", shape)
+    is_call = np.array([getattr(right, "value", right) == "C" for right in rights.ravel()], dtype=bool)
+    return np.broadcast_to(is_call.reshape(rights.shape), shape)
+
+def bs_iv_vec(prices, S, K, t, r=0, rights=None, precision=1e-6, max_iter=100, lower=1e-6, upper=5.0):
+    """
+    Vectorized implied volatility solver for calls and puts.
+
+    Runs Newton's method on every contract at once, falling back to bisection whenever a Newton
+    step leaves the current bracket [lower, upper] or vega vanishes. Only contracts that have not
+    yet converged are re-priced on each iteration.
+
+    Arguments:
+    prices: option prices
+    S: spot price of the underlying asset
+    K: strike prices
+    t: time to expiration (in years)
+    r: risk-free interest rate
+    rights: Right enums, 'C'/'P' strings or booleans (True for call); defaults to all calls
+    precision: absolute price tolerance for convergence
+    max_iter: maximum number of Newton/bisection iterations
+    lower, upper: initial volatility bracket
+
+    Returns:
+    np.ndarray of implied vols, NaN for quotes outside arbitrage bounds or that did not converge
+    """
+    with get_metrics().timer("stage_seconds", stage="iv_solve"):
+        return _bs_iv_vec(prices, S, K, t, r, rights, precision, max_iter, lower, upper)
+
+def _bs_iv_vec(prices, S, K, t, r, rights, precision, max_iter, lower, upper):
+    prices, S, K, t, r = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (prices, S, K, t, r)))
+    shape = prices.shape
+    is_call = rights_to_mask(rights, shape).ravel()
+    prices, S, K, t, r = (x.ravel() for x in (prices, S, K, t, r))
+    iv = np.full(prices.size, np.nan)
+
+    # no-arbitrage bounds: intrinsic <= price < upper bound (S for calls, discounted K for puts)
+    with np.errstate(invalid="ignore"):
+        discounted_K = K * np.exp(-r * t)
+        intrinsic = np.where(is_call, np.maximum(S - discounted_K, 0), np.maximum(discounted_K - S, 0))
+        bound = np.where(is_call, S, discounted_K)
+        valid = np.isfinite(prices) & (t > 0) & (K > 0) & (S > 0) & (prices > intrinsic) & (prices < bound)
+    idx = np.flatnonzero(valid)
+    if idx.size == 0:
+        return iv.reshape(shape)
+
+    price, s, k, tt, rr, call = prices[idx], S[idx], K[idx], t[idx], r[idx], is_call[idx]
+    lo = np.full(idx.size, lower)
+    hi = np.full(idx.size, upper)
+    sigma = np.full(idx.size, 0.2)
+    for _ in range(max_iter):
+        model = bs_price(s, k, sigma, tt, rr, rights=call)
+        diff = price - model
+        done = np.abs(diff) < precision
+        iv[idx[done]] = sigma[done]
+        active = ~done
+        if not active.any():
+            break
+        idx, price, s, k, tt, rr, call = idx[active], price[active], s[active], k[active], tt[active], rr[active], call[active]
+        sigma, diff, lo, hi = sigma[active], diff[active], lo[active], hi[active]
+        # price is increasing in vol, so the sign of diff tells us which side of the root we are on
+        lo = np.where(diff > 0, sigma, lo)
+        hi = np.where(diff < 0, sigma, hi)
+        vega = call_vega(s, k, sigma, tt, rr)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = sigma + diff / vega
+        use_bisection = ~np.isfinite(newton) | (newton <= lo) | (newton >= hi)
+        sigma = np.where(use_bisection, 0.5 * (lo + hi), newton)
+    return iv.reshape(shape)
+
+def bs_iv_bulk(prices, strikes, S, t=0, r=0, rights=None):
+    """
+    Implied vols for a whole chain at once, see bs_iv_vec. Non-convergent or arbitrage-violating quotes are NaN.
+    """
+    return bs_iv_vec(prices=prices, S=S, K=strikes, t=t, r=r, rights=rights)
+
+def bs_iv_chain(chain, S, r=0, prices=None):
+    """
+    Implied vols for every contract of an OptionChain.
+
+    Arguments:
+    chain: OptionChain
+    S: spot per chain date, shape (len(chain.dates),)
+    r: risk-free interest rate
+    prices: array shaped like the chain's fields, defaults to the bid/ask mid
+
+    Returns:
+    np.ndarray of shape chain.shape, NaN where bs_iv_vec fails or the contract is expired
+    """
+    prices = chain.mid() if prices is None else prices
+    S = np.asarray(S, dtype=np.float64)[None, None, :, None]
+    t = chain.time_to_expiry()[None, :, :, None]
+    return bs_iv_vec(prices=prices, S=S, K=chain.strikes, t=t, r=r, rights=chain.is_call()[:, None, None, None])
+
+def compare_greeks(chain, r=0, scale: dict=None, iv: str="implied_vol", spot: str="underlying_price") -> dict:
+    """
+    Differences between bs_greeks and the greeks of an OptionChain built from get_eod_greeks (e.g.
+    WrapperClient.get_greeks_chains_over_time), using the chain's own implied vol and underlying price.
+
+    Arguments:
+    chain: OptionChain with iv, spot and greek fields
+    r: risk-free interest rate
+    scale: per-greek factor applied to ours before comparing, e.g. {"theta": 1/365} for daily theta
+
+    Returns:
+    dict mapping each greek present in the chain to (ours - theirs), shaped like the chain's fields
+    """
+    scale = scale or {}
+    t = chain.time_to_expiry()[None, :, :, None]
+    ours = bs_greeks(chain[spot], chain.strikes, chain[iv], t, r, rights=chain.is_call()[:, None, None, None])
+    return {name: ours[name] * scale.get(name, 1) - chain[name] for name in GREEKS[1:] if name in chain.fields}
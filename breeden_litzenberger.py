@@ -1,26 +1,118 @@
-import pandas as pd
-from scipy.interpolate import interp1d
-from scipy.ndimage import gaussian_filter1d
-import matplotlib.pyplot as plt
 from black_scholes import *
+from ThetaDataClient import Right
 
-def pdf2(Krange, S, vol_surface: interp1d, t=0, r=0):
+def pdf2(Krange, S, vol_surface, t=0, r=0):
     Crange = black_scholes_call(S, Krange, vol_surface(Krange), t, r)
     first_deriv = np.gradient(Crange, Krange, edge_order=0)
     second_deriv = np.gradient(first_deriv, Krange, edge_order=0)
     return np.exp(r * t) * second_deriv
 
-def pdf_from_IV(strikes, vols, S, t, r):
+def pdf_from_IV(strikes, vols, S, t, r, show_plot: bool=False):
     """
     Interpolates vol then breeden-litzenberger to find option implied distribution.
     NOTE we interpolate vol and NOT price because interpolating in price space can lead to arbitrages.
     """
+    from scipy.interpolate import interp1d
     vol_surface = interp1d(strikes, vols, kind="cubic", fill_value="extrapolate")
     strike_range = np.arange(strikes.min(), strikes.max(), 0.1)
-    plot_vol_smile(strikes, vols, strike_range, vol_surface, S)
+    if show_plot:
+        plot_vol_smile(strikes, vols, strike_range, vol_surface, S)
     return (strike_range, pdf2(Krange=strike_range, S=S, vol_surface=vol_surface, t=t, r=r), black_scholes_call(S, strike_range, vol_surface(strike_range), t, r))
 
+def _pdf_smiles(strikes, vols, S, t, r, strike_range):
+    """
+    Breeden-litzenberger for a stack of smiles on a shared strike grid.
+
+    Arguments:
+    strikes: (K,) sorted strikes
+    vols: (N, K) implied vols, NaN where a strike has no quote
+    S, t: (N,) spot and time to expiry of each smile
+    strike_range: (G,) strike grid inside [strikes.min(), strikes.max()]
+
+    Returns:
+    (pdf, prices) each of shape (N, G), NaN rows for smiles with fewer than 4 quotes
+    """
+    from scipy.interpolate import CubicSpline
+    num_smiles = vols.shape[0]
+    grid_vols = np.full((num_smiles, strike_range.size), np.nan)
+    finite = np.isfinite(vols)
+    complete = finite.all(axis=1)
+    if complete.any():
+        # one spline fit for every fully quoted smile
+        grid_vols[complete] = CubicSpline(strikes, vols[complete].T, axis=0)(strike_range).T
+    for i in np.flatnonzero(~complete & (finite.sum(axis=1) >= 4)):
+        quoted = finite[i]
+        spline = CubicSpline(strikes[quoted], vols[i, quoted])
+        inside = (strike_range >= strikes[quoted][0]) & (strike_range <= strikes[quoted][-1])
+        grid_vols[i, inside] = spline(strike_range[inside])
+    prices = black_scholes_call(S[:, None], strike_range[None, :], grid_vols, t[:, None], r)
+    first_deriv = np.gradient(prices, strike_range, axis=1, edge_order=2)
+    second_deriv = np.gradient(first_deriv, strike_range, axis=1, edge_order=2)
+    return (np.exp(r * t)[:, None] * second_deriv, prices)
+
+def _pdf_cube_chunk(args):
+    return _pdf_smiles(*args)
+
+def pdf_cube(strikes, iv_cube, S, t, r=0, step: float=0.1, num_workers: int=None):
+    """
+    Vectorized breeden-litzenberger over a (dates x expiries x strikes) IV cube.
+
+    Every smile is interpolated with a cubic spline (same as pdf_from_IV) onto one shared strike grid, smiles without
+    missing quotes are fitted together in a single call and partially quoted ones on their quoted range only.
+
+    Arguments:
+    strikes: (K,) strikes shared by the cube
+    iv_cube: (D, E, K) implied vols, NaN where missing
+    S: spot per date, shape (D,) or (D, E)
+    t: time to expiry in years, shape (E,) or (D, E)
+    r: risk-free rate
+    step: strike grid spacing
+    num_workers: if > 1, dates are split across a process pool
+
+    Returns:
+    (strike_range, pdf, prices) with pdf and prices of shape (D, E, len(strike_range))
+    """
+    strikes = np.asarray(strikes, dtype=np.float64)
+    iv_cube = np.asarray(iv_cube, dtype=np.float64)
+    order = np.argsort(strikes)
+    strikes, iv_cube = strikes[order], iv_cube[..., order]
+    num_dates, num_expiries, _ = iv_cube.shape
+    S = np.broadcast_to(np.asarray(S, dtype=np.float64).reshape(num_dates, -1), (num_dates, num_expiries))
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), (num_dates, num_expiries))
+    strike_range = np.arange(strikes.min(), strikes.max(), step)
+    vols = iv_cube.reshape(-1, strikes.size)
+    if num_workers is None or num_workers <= 1 or num_dates < 2:
+        pdf, prices = _pdf_smiles(strikes, vols, S.ravel(), t.ravel(), r, strike_range)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        bounds = np.linspace(0, num_dates, min(num_workers, num_dates) + 1).astype(int) * num_expiries
+        chunks = [(strikes, vols[a:b], S.ravel()[a:b], t.ravel()[a:b], r, strike_range) for a, b in zip(bounds[:-1], bounds[1:])]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_pdf_cube_chunk, chunks))
+        pdf = np.concatenate([result[0] for result in results])
+        prices = np.concatenate([result[1] for result in results])
+    shape = (num_dates, num_expiries, strike_range.size)
+    return (strike_range, pdf.reshape(shape), prices.reshape(shape))
+
+def pdf_from_chain(chain, S, r=0, iv=None, right=Right.CALL, step: float=0.1, num_workers: int=None):
+    """
+    pdf_cube over every date and expiration of an OptionChain.
+
+    Arguments:
+    chain: OptionChain
+    S: spot per chain date, shape (len(chain.dates),)
+    iv: implied vols shaped like the chain's fields, defaults to bs_iv_chain on the mid
+    right: which right's smile to use
+
+    Returns:
+    (strike_range, pdf, prices) with pdf and prices of shape (dates, expirations, len(strike_range))
+    """
+    iv = bs_iv_chain(chain, S, r) if iv is None else iv
+    i = chain.right_index(right)
+    return pdf_cube(chain.strikes, iv[i].transpose(1, 0, 2), S, chain.time_to_expiry().T, r=r, step=step, num_workers=num_workers)
+
 def plot_vols(strikes, vols, S):
+    import matplotlib.pyplot as plt
     plt.plot(strikes, vols, "bx")
     plt.axvline(S, color="k", linestyle="--")
     plt.legend(["smoothed IV"], loc="best")
@@ -30,6 +122,7 @@ def plot_vols(strikes, vols, S):
     plt.show()
 
 def plot_vol_smile(strikes, vols, Krange, vol_surface, S):
+    import matplotlib.pyplot as plt
     plt.plot(strikes, vols, "bx", Krange, vol_surface(Krange), "k-")
     plt.axvline(S, color="k", linestyle="--")
     plt.legend(["smoothed IV", "fitted smile"], loc="best")
@@ -39,6 +132,7 @@ def plot_vol_smile(strikes, vols, Krange, vol_surface, S):
     plt.show()
 
 def plot_pdf_and_prices(Krange, prices, pdf, S):
+    import matplotlib.pyplot as plt
     print(pdf)
     fig, ax1 = plt.subplots(figsize=(9,6))
     col="blue"
@@ -57,6 +151,8 @@ def plot_pdf_and_prices(Krange, prices, pdf, S):
     
 
 if __name__ == "__main__":
+    import pandas as pd
+    from scipy.ndimage import gaussian_filter1d
     # for testing to match with source
     calls = pd.read_excel("SPY_191020exp_290920.xlsx", sheet_name="call")
     calls["midprice"] = (calls.bid + calls.ask)/2
@@ -66,7 +162,7 @@ if __name__ == "__main__":
     calls.iv = gaussian_filter1d(calls.iv, 3)
     calls = calls[(calls.strike > 300) & (calls.strike < 375)]
 
-    Krange, pdf, prices = pdf_from_IV(calls.strike, calls.iv, S = 332, t = 3/52, r = 0)
+    Krange, pdf, prices = pdf_from_IV(calls.strike, calls.iv, S = 332, t = 3/52, r = 0, show_plot=True)
 
     plot_pdf_and_prices(Krange, prices, pdf, 332)
     
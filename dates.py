@@ -0,0 +1,24 @@
+import numpy as np
+
+def yyyymmdd_to_days(dates) -> np.ndarray:
+    """
+    ThetaData YYYYMMDD ints (or strings) to int64 days since epoch, without strptime
+    """
+    dates = np.asarray(dates, dtype=np.int64)
+    years, months, days = dates // 10000, dates // 100 % 100, dates % 100
+    months_since_epoch = (years - 1970) * 12 + (months - 1)
+    return (months_since_epoch.astype("datetime64[M]").astype("datetime64[D]") + (days - 1)).astype(np.int64)
+
+def datetime_to_days(dates) -> np.ndarray:
+    """
+    datetime64 values (or a DatetimeIndex/Series of them) to int64 days since epoch
+    """
+    return np.asarray(getattr(dates, "values", dates)).astype("datetime64[D]").astype(np.int64)
+
+def days_to_yyyymmdd(days) -> np.ndarray:
+    dates = np.asarray(days, dtype=np.int64).astype("datetime64[D]")
+    years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    months = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    day_of_month = (dates - dates.astype("datetime64[M]")).astype(np.int64) + 1
+    return years * 10000 + months * 100 + day_of_month
+
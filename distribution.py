@@ -1,55 +1,115 @@
-import yfinance as yf
-from pandas_datareader import data as pdr
-yf.pdr_override()
 import datetime as dt
 import numpy as np
 import pandas as pd
 import math
-from scipy.stats import gaussian_kde
-from scipy.integrate import quad
-import matplotlib.pyplot as plt
 
-import warnings
-warnings.filterwarnings("ignore")
-    
-g_vix = pdr.get_data_yahoo(['^VIX'], dt.date(2000, 1, 1), dt.date.today(), progress=False)['Adj Close']
+from market_data import get_store
+
 
 def query_option_chain(ticker: str) -> tuple:
+    import yfinance as yf
     security = yf.Ticker(ticker)
     expiries = security.options
     option_chain = security.option_chain(date=expiries[0])
     return (option_chain.calls, option_chain.puts)
 
+# regime edges for vix_parametrize: 0-8, 8-16, 16-24, 24-32, 32-40, >40
+VIX_EDGES = [8, 16, 24, 32, 40]
+# VIX settles at 16:15 ET, a close is only known to intraday returns stamped after it
+VIX_CLOSE_TIME = pd.Timedelta(hours=16, minutes=15)
+
 # creates PDF from KDE given samples
 def generate_kde(data, show_plot=False):
-    min_return = data.min()
-    max_return = data.max()
+    from scipy.stats import gaussian_kde
     kde = gaussian_kde(data.dropna())
-    xrange = np.linspace(2*min_return, 2*max_return, data.size - 1)
     if show_plot:
+        import matplotlib.pyplot as plt
+        xrange = np.linspace(2*data.min(), 2*data.max(), 1000)
         plt.plot(xrange, kde(xrange), color='k', label='KDE')
         plt.show()
     return kde
 
 # creates profit function given distribution
-def pdf_creator(kde: gaussian_kde, strike: float, spot: float):
+def pdf_creator(kde, strike: float, spot: float):
     def pdf(x):
-        return kde.evaluate(x) * max(0, spot * math.exp(x) - strike)
+        return kde.evaluate(x)[0] * max(0, spot * math.exp(x) - strike)
     return pdf
 
+def vix_regimes(returns: pd.Series, vix: pd.Series=None, edges=VIX_EDGES, lag: int=0, window: int=1) -> pd.Series:
+    """
+    Assigns every return to a VIX regime by date rather than by position.
+
+    Arguments:
+    returns: returns indexed by date (daily or intraday timestamps in exchange time)
+    vix: VIX closes indexed by date, defaults to ^VIX from the market data store
+    edges: regime boundaries, regime i covers [edges[i-1], edges[i])
+    lag: number of VIX closes to lag by (1 to only use the previous close)
+    window: rolling mean of VIX closes used for membership, 1 for the spot close
+
+    Returns:
+    pd.Series of int regimes aligned with returns, -1 where there is no VIX close yet
+    """
+    if vix is None:
+        vix = get_store().closes('^VIX', returns.index[0].date() - dt.timedelta(days=7 * (lag + window)))
+    level = vix.dropna().rolling(window).mean().shift(lag)
+    if (returns.index != returns.index.normalize()).any():
+        # intraday returns: stamp each close at the end of its session so a day's returns see the previous close
+        level.index = level.index.normalize() + VIX_CLOSE_TIME
+    # last close known at each return's timestamp (same-day close for daily returns)
+    level = level.reindex(level.index.union(returns.index)).ffill().reindex(returns.index).to_numpy()
+    regimes = np.where(np.isfinite(level), np.digitize(level, edges), -1)
+    return pd.Series(regimes, index=returns.index, name="regime")
+
 # buckets data by spot vix level
-def vix_parametrize(data):
-    start_date = data.index[0]
-    vix = g_vix[start_date:]
-    vix_parametrized_returns = [[] for _ in range(6)]
-    for i in range(1, data.size):
-        vix_parametrized_returns[min(int(vix[i] // 8), 5)].append(data[i])
-    return vix_parametrized_returns
+def vix_parametrize(data, vix: pd.Series=None, edges=VIX_EDGES, lag: int=0, window: int=1):
+    data = data.dropna()
+    regimes = vix_regimes(data, vix=vix, edges=edges, lag=lag, window=window)
+    groups = data.groupby(regimes.to_numpy())
+    return [groups.get_group(regime).tolist() if regime in groups.groups else [] for regime in range(len(edges) + 1)]
+
+def fit_regime_densities(returns: pd.Series, regimes: pd.Series, grid: np.ndarray, min_samples: int=30, chunk_size: int=512):
+    """
+    Gaussian KDEs (Scott's rule bandwidth per regime) for every regime evaluated on the grid in one batched pass.
+
+    Each sample carries its regime's bandwidth and normalization, and kernel contributions are accumulated into all
+    regimes at once with a (samples x regimes) indicator matrix.
+
+    Returns:
+    (labels, densities) where densities[i] is the density of regime labels[i] on grid, for regimes with at least
+    min_samples returns
+    """
+    returns = returns.dropna()
+    regimes = regimes.reindex(returns.index).to_numpy()
+    samples = returns.to_numpy(dtype=np.float64)
+    labels, inverse, counts = np.unique(regimes, return_inverse=True, return_counts=True)
+    valid = (counts >= min_samples) & (labels >= 0)
+    keep = valid[inverse]
+    samples, inverse = samples[keep], inverse[keep]
+    remap = np.cumsum(valid) - 1
+    inverse = remap[inverse]
+    labels, counts = labels[valid], counts[valid]
+    # Scott's rule per regime, same as gaussian_kde
+    sums = np.bincount(inverse, weights=samples, minlength=labels.size)
+    squares = np.bincount(inverse, weights=samples * samples, minlength=labels.size)
+    std = np.sqrt((squares - sums * sums / counts) / (counts - 1))
+    bandwidths = std * counts ** (-1 / 5)
+    h = bandwidths[inverse]
+    scale = 1 / (counts[inverse] * h * math.sqrt(2 * math.pi))
+    densities = np.zeros((labels.size, grid.size))
+    for i in range(0, samples.size, chunk_size):
+        chunk = slice(i, i + chunk_size)
+        z = (grid[:, None] - samples[None, chunk]) / h[None, chunk]
+        kernels = np.exp(-0.5 * z * z) * scale[None, chunk]
+        indicator = np.zeros((kernels.shape[1], labels.size))
+        indicator[np.arange(kernels.shape[1]), inverse[chunk]] = 1
+        densities += (kernels @ indicator).T
+    return (labels, densities)
 
 if __name__ == "__main__":
-    svix = pdr.get_data_yahoo(['SVIX'], dt.date(2020, 3, 30), dt.date.today(), progress=False)['Adj Close']
+    from scipy.integrate import quad
+    svix = get_store().closes('SVIX', dt.date(2020, 3, 30))
     svix_daily_returns = np.log(svix/svix.shift(1))
-    svxy = pdr.get_data_yahoo(['SVXY'], dt.date(2000, 1, 1), dt.date.today(), progress=False)['Adj Close']
+    svxy = get_store().closes('SVXY', dt.date(2000, 1, 1))
     svxy_daily_returns = np.log(svxy/svxy.shift(1))
     #generate_kde(svix_daily_returns, True)
     svix_vix_parametrized_returns = vix_parametrize(svix_daily_returns)
@@ -1,13 +1,197 @@
-import yfinance as yf
-from pandas_datareader import data as pdr
-yf.pdr_override()
 import datetime as dt
+import numpy as np
+import pandas as pd
 
 from ThetaDataClient import Right
+from market_data import MarketDataStore, get_store
+from option_chain import CALL
+from dates import yyyymmdd_to_days, datetime_to_days
+from black_scholes import rights_to_mask
+from metrics import get_metrics
+
+SIGNAL_COLUMNS = ["date", "exp", "strike", "right", "direction", "entry", "theo"]
+
+def to_days(dates) -> np.ndarray:
+    """
+    Converts dates (datetime64, Timestamps, dt.date or YYYYMMDD ints/strings) to int64 days since epoch
+    """
+    dates = pd.Series(dates)
+    if dates.dtype.kind in "iu":
+        return yyyymmdd_to_days(dates.to_numpy())
+    return datetime_to_days(pd.to_datetime(dates))
+
+def _positions(values: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """
+    Index of each query in sorted values, -1 where it isn't there
+    """
+    index = np.minimum(np.searchsorted(values, query), values.size - 1)
+    return np.where(values[index] == query, index, -1)
+
 class Engine:
-    def __init__(self, root: str, start_date: dt.date):
+    def __init__(self, root: str, start_date: dt.date, market_data: MarketDataStore=None):
         self.pnl = 0
-        self.spot_price = pdr.get_data_yahoo([root], start_date, dt.date.today())['Adj Close']
+        self.trades = []
+        market_data = market_data if market_data is not None else get_store()
+        self.spot_price = market_data.closes(root, start_date)
+        # integer-indexed copy of the closes for vectorized lookups
+        self.spot_days = datetime_to_days(self.spot_price.index)
+        self.spot_values = self.spot_price.values.astype(np.float64)
+
+    def spot_index(self, days: np.ndarray) -> np.ndarray:
+        """
+        Index of the last close on or before each day, -1 if there is none
+        """
+        return np.searchsorted(self.spot_days, days, side="right") - 1
+
+    def pnl_option_to_expiry(self, entry: float, strike: float, exp: dt.date, right: Right, direction: int, date: dt.date=None, theo: float=np.nan):
+        """
+        Update backtest PnL with new option held-to-expiry trade, trades expiring after the last close are recorded but
+        only add to pnl once they can be settled (see run)
+        """
+        trade = pd.DataFrame([[date if date is not None else exp, exp, strike, right.value, direction, entry, theo]], columns=SIGNAL_COLUMNS)
+        self.trades.append(trade)
+        pnl = float(self.run(trade)["pnl"].iloc[0])
+        if np.isfinite(pnl):
+            self.pnl += pnl
+
+    def get_signals(self) -> pd.DataFrame:
+        if not self.trades:
+            return pd.DataFrame(columns=SIGNAL_COLUMNS)
+        return pd.concat(self.trades, ignore_index=True)
+
+    def run(self, signals: pd.DataFrame) -> pd.DataFrame:
+        """
+        Held-to-expiry PnL of every signal at once.
+
+        Arguments:
+        signals: table with columns date, exp, strike, right ('C'/'P' or Right), direction (+1 long, -1 short), entry, theo
+
+        Returns:
+        signals with spot_at_expiry, payoff and pnl columns added, NaN when there is no close on or before expiry or
+        when expiry is after the last stored close (the trade is still open)
+        """
+        with get_metrics().timer("stage_seconds", stage="pnl"):
+            return self._run(signals)
+
+    def _run(self, signals: pd.DataFrame) -> pd.DataFrame:
+        result = signals.reset_index(drop=True).copy()
+        exp_days = to_days(result["exp"])
+        exp_index = self.spot_index(exp_days)
+        # expiring before the first close or after the last one: nothing to settle against yet
+        settled = (exp_index >= 0) & (exp_days <= self.spot_days[-1])
+        spot_at_expiry = np.where(settled, self.spot_values[np.maximum(exp_index, 0)], np.nan)
+        is_call = rights_to_mask(result["right"].to_numpy(), len(result))
+        strike = result["strike"].to_numpy(dtype=np.float64)
+        payoff = np.maximum(np.where(is_call, spot_at_expiry - strike, strike - spot_at_expiry), 0)
+        result["right"] = np.where(is_call, Right.CALL.value, Right.PUT.value)
+        result["spot_at_expiry"] = spot_at_expiry
+        result["payoff"] = payoff
+        result["pnl"] = result["direction"].to_numpy(dtype=np.float64) * (payoff - result["entry"].to_numpy(dtype=np.float64))
+        return result
+
+    def chain_spots(self, chain) -> np.ndarray:
+        """
+        Close on or before each date of an OptionChain, NaN if there is none
+        """
+        index = self.spot_index(chain.dates)
+        return np.where(index >= 0, self.spot_values[np.maximum(index, 0)], np.nan)
+
+    def signals_from_chain(self, chain, direction: np.ndarray, theos: np.ndarray=None, bid: str="bid", ask: str="ask") -> pd.DataFrame:
+        """
+        Signal table for an OptionChain, buying at the ask and selling at the bid.
+
+        Arguments:
+        chain: OptionChain
+        direction: array shaped like the chain's fields, +1 long, -1 short, 0 no trade
+        theos: optional theos shaped like the chain's fields
+        """
+        direction = np.nan_to_num(np.asarray(direction, dtype=np.float64)).astype(np.int64)
+        r, e, d, k = np.nonzero(direction)
+        side = direction[r, e, d, k]
+        entry = np.where(side == 1, chain[ask][r, e, d, k], chain[bid][r, e, d, k])
+        return pd.DataFrame({
+            "date": chain.dates[d].astype("datetime64[D]"),
+            "exp": chain.expirations[e].astype("datetime64[D]"),
+            "strike": chain.strikes[k],
+            "right": np.where(chain.rights[r] == CALL, Right.CALL.value, Right.PUT.value),
+            "direction": side,
+            "entry": entry,
+            "theo": np.nan if theos is None else theos[r, e, d, k],
+        }, columns=SIGNAL_COLUMNS)
+
+    def run_chain(self, chain, direction: np.ndarray, theos: np.ndarray=None, bid: str="bid", ask: str="ask") -> pd.DataFrame:
+        """
+        Held-to-expiry PnL of trading an OptionChain, see signals_from_chain and run
+        """
+        return self.run(self.signals_from_chain(chain, direction, theos=theos, bid=bid, ask=ask))
+
+    def mark_to_market(self, signals: pd.DataFrame, marks=None, bid: str="bid", ask: str="ask", chunk_size: int=1024) -> pd.Series:
+        """
+        Daily PnL of the whole book, marking open positions at their mid in marks on each close and holding the expiry
+        payoff afterwards. Days a contract has no quote in marks (or without marks at all) fall back to intrinsic value
+        against the close. Trades expiring after the last close stay open, trades expiring before the first close are
+        left out.
+
+        Arguments:
+        signals: table with columns date, exp, strike, right, direction, entry (see run)
+        marks: optional OptionChain with bid and ask fields, matched to trades by (date, exp, strike, right)
+
+        Returns:
+        pd.Series of cumulative PnL indexed like spot_price
+        """
+        entry_index = np.maximum(self.spot_index(to_days(signals["date"])), 0)
+        exp_days = to_days(signals["exp"])
+        exp_index = self.spot_index(exp_days)
+        days = np.arange(self.spot_values.size)
+        # still open at the last close: never settle, keep marking against each close
+        exp_index = np.where(exp_days > self.spot_days[-1], days.size, exp_index)
+        # no close on or before expiry, nothing to mark against
+        has_close = exp_index >= 0
+        is_call = rights_to_mask(signals["right"].to_numpy(), len(signals))
+        strike = signals["strike"].to_numpy(dtype=np.float64)
+        direction = signals["direction"].to_numpy(dtype=np.float64)
+        entry = signals["entry"].to_numpy(dtype=np.float64)
+        use_marks = marks is not None and 0 not in marks.shape
+        if use_marks:
+            mid = marks.mid(bid, ask)
+            # position of every trade's contract and every close in the chain, -1 where it isn't quoted
+            mark_right = np.full(strike.size, -1)
+            for i, code in enumerate(marks.rights):
+                mark_right[is_call == (code == CALL)] = i
+            mark_exp = _positions(marks.expirations, exp_days)
+            mark_strike = _positions(marks.strikes, strike)
+            mark_date = _positions(marks.dates, self.spot_days)
+            has_mark = (mark_right >= 0) & (mark_exp >= 0) & (mark_strike >= 0)
+        total = np.zeros(days.size)
+        for i in range(0, strike.size, chunk_size):
+            chunk = slice(i, i + chunk_size)
+            # mark each trade at the close of min(day, expiry), zero before entry
+            mark_index = np.minimum(days[:, None], exp_index[None, chunk])
+            spot = self.spot_values[np.maximum(mark_index, 0)]
+            value = np.maximum(np.where(is_call[None, chunk], spot - strike[None, chunk], strike[None, chunk] - spot), 0)
+            if use_marks:
+                # quoted mids before expiry, the expiry close settles at intrinsic
+                quoted = mid[np.maximum(mark_right[None, chunk], 0), np.maximum(mark_exp[None, chunk], 0), np.maximum(mark_date[:, None], 0), np.maximum(mark_strike[None, chunk], 0)]
+                use_mark = (days[:, None] < exp_index[None, chunk]) & has_mark[None, chunk] & (mark_date[:, None] >= 0) & np.isfinite(quoted)
+                value = np.where(use_mark, quoted, value)
+            pnl = direction[None, chunk] * (value - entry[None, chunk])
+            total += np.where((days[:, None] >= entry_index[None, chunk]) & has_close[None, chunk], pnl, 0).sum(axis=1)
+        return pd.Series(total, index=self.spot_price.index, name="pnl")
+
+    @staticmethod
+    def stats(results: pd.DataFrame) -> pd.DataFrame:
+        """
+        Trade count, total and average PnL and hit rate per (right, direction) bucket, over settled trades only
+        """
+        pnl = results["pnl"]
+        # NaN for open trades so the hit rate skips them like the other columns do
+        grouped = results.assign(win=np.where(pnl.notna(), pnl > 0, np.nan)).groupby(["right", "direction"])
+        return pd.DataFrame({"trades": grouped["pnl"].count(), "pnl": grouped["pnl"].sum(), "avg_pnl": grouped["pnl"].mean(), "hit_rate": grouped["win"].mean()})
 
-    def pnl_option_to_expiry(self, entry: float, strike: float, exp: dt.date, right: Right, direction: int):
-        self.pnl += direction * (max((right==Right.CALL - right==Right.PUT)*(self.spot_price[exp.strftime("%Y-%m-%d")] - strike), 0) - entry) 
\ No newline at end of file
+    def print_pnl(self, results: pd.DataFrame=None):
+        results = results if results is not None else self.run(self.get_signals())
+        stats = self.stats(results)
+        for right, name in ((Right.CALL.value, "calls"), (Right.PUT.value, "puts")):
+            for direction, side in ((1, "long"), (-1, "short")):
+                count, pnl = (stats.loc[(right, direction), ["trades", "pnl"]] if (right, direction) in stats.index else (0, 0))
+                print(f"{name} {side}: {int(count)}, {name} {side} PnL: {pnl}")
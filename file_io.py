@@ -0,0 +1,22 @@
+import os
+import threading
+from contextlib import contextmanager
+
+@contextmanager
+def atomic_write(path: str, mode: str="wb"):
+    """
+    Writes to a temporary file next to path and moves it over path once the block exits cleanly, so readers (and
+    other processes or threads writing the same path) never see a partial file.
+
+    Arguments:
+    path: destination file
+    mode: open() mode of the temporary file, "wb" or "w"
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
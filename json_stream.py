@@ -0,0 +1,232 @@
+import json
+import codecs
+from typing import Iterable
+
+import numpy as np
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+
+class ColumnBuilder:
+    def __init__(self, capacity: int=1024, batch_size: int=4096):
+        """
+        Fills typed column arrays from rows without keeping the rows around.
+
+        Rows are buffered in small batches that are converted with a single np.array call. Columns whose first values
+        are ints are stored as int64 and upcast to float64 only if a non-integral value shows up.
+
+        Arguments:
+        capacity: initial number of rows to preallocate, grown by doubling
+        batch_size: number of rows converted at a time
+        """
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.columns = None
+        self.size = 0
+        self._batch = []
+
+    def reserve(self, capacity: int):
+        if self.columns is None:
+            self.capacity = max(self.capacity, capacity)
+        elif capacity > self.capacity:
+            self.columns = [np.resize(column, capacity) for column in self.columns]
+            self.capacity = capacity
+
+    def append(self, row: list):
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        if self.columns is None:
+            first = self._batch[0]
+            self.columns = [np.empty(self.capacity, dtype=np.int64 if isinstance(v, int) else np.float64) for v in first]
+        batch = np.array(self._batch, dtype=np.float64)
+        self._batch = []
+        n = batch.shape[0]
+        if self.size + n > self.capacity:
+            self.reserve(max(2 * self.capacity, self.size + n))
+        for i, column in enumerate(self.columns):
+            values = batch[:, i]
+            if column.dtype == np.int64 and not np.array_equal(values, np.trunc(values), equal_nan=False):
+                column = self.columns[i] = column.astype(np.float64)
+            column[self.size:self.size + n] = values
+        self.size += n
+
+    def finish(self, names: list[str]) -> dict:
+        self.flush()
+        if self.columns is None:
+            return {name: np.empty(0) for name in names}
+        return {name: column[:self.size] for name, column in zip(names, self.columns)}
+
+
+class _Stream:
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.consumed = 0
+
+    def read_more(self, min_chars: int=1) -> bool:
+        """
+        Appends at least min_chars of new text (fewer at the end of the stream), joining the chunks once
+        """
+        if self.eof:
+            return False
+        parts = []
+        size = 0
+        while size < max(min_chars, 1):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                parts.append(self.text.decode(b"", final=True))
+                break
+            parts.append(self.text.decode(chunk))
+            size += len(parts[-1])
+        # drop everything already parsed so the buffer stays about one chunk long
+        self.consumed += self.pos
+        self.buf = self.buf[self.pos:] + "".join(parts)
+        self.pos = 0
+        return size > 0 or not self.eof
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                raise ValueError("unexpected end of JSON stream")
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"expected '{char}' at offset {self.consumed + self.pos}, got '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # at least double what is buffered before trying again, so a value spanning many chunks isn't
+                # reparsed from its start on every chunk
+                if not self.read_more(len(self.buf) - self.pos):
+                    raise
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self.read_more():
+                continue
+            self.pos = end
+            return value
+
+
+def _rows(stream: _Stream, on_row):
+    """
+    Parses a JSON array of rows one row at a time, calling on_row on each
+
+    Returns:
+    number of rows
+    """
+    count = 0
+    stream.expect("[")
+    while stream.peek() != "]":
+        on_row(stream.value())
+        count += 1
+        if stream.peek() == ",":
+            stream.pos += 1
+    stream.pos += 1
+    return count
+
+def decode_stream(chunks: Iterable[bytes], content_length: int=None) -> dict:
+    """
+    Incrementally decodes a ThetaData JSON body ({"header": ..., "response": [...]}) into NumPy columns.
+
+    Rows, including the ticks of each bulk contract, are parsed one at a time from the byte chunks and written straight
+    into typed column arrays, so peak memory is proportional to the final arrays rather than the JSON tree.
+
+    Returns:
+    for row responses, {"header": header, "response": {field: np.ndarray}} keyed by header["format"]
+    for bulk responses, additionally "contracts" (list of contract dicts) and "offsets" (tick range of each contract)
+    for lists of scalars, {"header": header, "response": np.ndarray}
+    """
+    stream = _Stream(chunks)
+    header = None
+    builder = ColumnBuilder()
+    contracts = None
+    offsets = None
+    scalars = None
+    rows = 0
+    reserved = False
+
+    def append(row: list):
+        nonlocal rows, reserved
+        builder.append(row)
+        rows += 1
+        if content_length is not None and not reserved and rows >= 64:
+            # size the columns from the bytes used by the first rows
+            builder.reserve(int(1.05 * content_length / ((stream.consumed + stream.pos) / rows)) + 1)
+            reserved = True
+
+    stream.expect("{")
+    while stream.peek() != "}":
+        key = stream.value()
+        stream.expect(":")
+        if key != "response" or stream.peek() != "[":
+            value = stream.value()
+            if key == "header":
+                header = value
+        else:
+            stream.expect("[")
+            while stream.peek() != "]":
+                if stream.peek() == "{":
+                    # bulk element, {"contract": {...}, "ticks": [[...], ...]}
+                    contracts = contracts if contracts is not None else []
+                    offsets = offsets if offsets is not None else [0]
+                    contract = None
+                    num_ticks = 0
+                    stream.expect("{")
+                    while stream.peek() != "}":
+                        name = stream.value()
+                        stream.expect(":")
+                        if name == "ticks" and stream.peek() == "[":
+                            num_ticks += _rows(stream, append)
+                        else:
+                            value = stream.value()
+                            if name == "contract":
+                                contract = value
+                        if stream.peek() == ",":
+                            stream.pos += 1
+                    stream.pos += 1
+                    contracts.append(contract)
+                    offsets.append(offsets[-1] + num_ticks)
+                else:
+                    element = stream.value()
+                    if isinstance(element, list):
+                        append(element)
+                    else:
+                        scalars = scalars if scalars is not None else []
+                        scalars.append(element)
+                if stream.peek() == ",":
+                    stream.pos += 1
+            stream.pos += 1
+        if stream.peek() == ",":
+            stream.pos += 1
+    if header is None:
+        raise ValueError("JSON stream has no header")
+    if scalars is not None:
+        return {"header": header, "response": np.asarray(scalars)}
+    names = header.get("format") or []
+    if builder.columns is not None or builder._batch:
+        width = len(builder._batch[0]) if builder._batch else len(builder.columns)
+        names = list(names) + [str(i) for i in range(len(names), width)]
+    data = {"header": header, "response": builder.finish(names)}
+    if contracts is not None:
+        data["contracts"] = contracts
+        data["offsets"] = np.asarray(offsets, dtype=np.int64)
+    return data
@@ -0,0 +1,202 @@
+import time
+import asyncio
+import numpy as np
+
+from model import Model
+from metrics import Histogram
+
+TICK_DTYPE = np.dtype([("date", "<i8"), ("ms_of_day", "<i8"), ("strike", "<f8"), ("is_call", "?"), ("bid", "<f8"), ("ask", "<f8"), ("spot", "<f8")])
+# seconds, per-tick processing is in the microseconds
+TICK_LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 0.1)
+SIGNAL_DTYPE = np.dtype([("date", "<i8"), ("ms_of_day", "<i8"), ("strike", "<f8"), ("is_call", "?"), ("bid", "<f8"), ("ask", "<f8"), ("spot", "<f8"), ("theo", "<f8"), ("direction", "<i8"), ("latency_ns", "<i8")])
+
+def ticks_from_bulk(bulk: dict, spot_ms: np.ndarray, spot_prices: np.ndarray, spot_dates: np.ndarray=None) -> np.ndarray:
+    """
+    Converts a streamed bulk_hist quote response (see json_stream.decode_stream) into ticks ordered by time, each
+    carrying the last underlying price at or before it.
+
+    Arguments:
+    bulk: decoded bulk response with contracts, offsets and date/ms_of_day/bid/ask columns
+    spot_ms: ms_of_day of the underlying prices, sorted within each date
+    spot_prices: underlying prices
+    spot_dates: YYYYMMDD dates of the underlying prices, None if they are all on the ticks' date
+
+    Returns:
+    np.ndarray of TICK_DTYPE (strikes in dollars)
+    """
+    contracts = bulk["contracts"]
+    ticks = bulk["response"]
+    num_ticks = np.diff(bulk["offsets"])
+    contract_of_tick = np.repeat(np.arange(len(contracts)), num_ticks)
+    data = np.empty(contract_of_tick.size, dtype=TICK_DTYPE)
+    data["date"] = ticks["date"]
+    data["ms_of_day"] = ticks["ms_of_day"]
+    data["strike"] = np.array([contract["strike"] for contract in contracts], dtype=np.float64)[contract_of_tick] / 1000
+    data["is_call"] = np.array([contract["right"] == "C" for contract in contracts], dtype=bool)[contract_of_tick]
+    data["bid"] = ticks["bid"]
+    data["ask"] = ticks["ask"]
+    data = np.sort(data, order=["date", "ms_of_day"])
+    # as-of join on (date, ms_of_day), ticks before the first underlying price get NaN
+    spot_time = np.asarray(spot_ms, dtype=np.int64) if spot_dates is None else np.asarray(spot_dates, dtype=np.int64) * 86_400_000 + np.asarray(spot_ms, dtype=np.int64)
+    tick_time = data["ms_of_day"] if spot_dates is None else data["date"] * 86_400_000 + data["ms_of_day"]
+    index = np.searchsorted(spot_time, tick_time, side="right") - 1
+    data["spot"] = np.where(index >= 0, np.asarray(spot_prices, dtype=np.float64)[np.maximum(index, 0)], np.nan)
+    return data
+
+def save_ticks(ticks: np.ndarray, path: str) -> str:
+    np.save(path, ticks)
+    return path
+
+def load_ticks(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode="r")
+
+async def replay(ticks: np.ndarray, speed: float=None):
+    """
+    Yields ticks one at a time. With speed set, waits between ticks for their ms_of_day gap divided by speed (1.0 is
+    real time), otherwise replays as fast as the consumer reads.
+    """
+    last = None
+    for tick in ticks:
+        if speed is not None and last is not None and tick["date"] == last["date"]:
+            await asyncio.sleep(max(int(tick["ms_of_day"]) - int(last["ms_of_day"]), 0) / 1000 / speed)
+        last = tick
+        yield tick
+
+async def replay_terminal(api, root: str, exp: str, date: str, spot_ms: np.ndarray, spot_prices: np.ndarray, ivl: int=None, speed: float=None):
+    """
+    Replays one day of quotes for an expiration from the terminal (or a local stand-in on the same port)
+    """
+    bulk = await asyncio.to_thread(api.get_bulk_hist_quotes, root=root, exp=exp, start_date=date, end_date=date, ivl=ivl, stream=True)
+    async for tick in replay(ticks_from_bulk(bulk, spot_ms, spot_prices), speed=speed):
+        yield tick
+
+
+class TheoCurves:
+    def __init__(self, model: Model, spot: float, width: float=0.1, points: int=2001):
+        """
+        Theos of each contract precomputed on a spot grid around spot, so a tick costs one linear interpolation
+        instead of a pricing call.
+
+        Arguments:
+        model: fitted Model
+        spot: center of the spot grid
+        width: grid covers spot * (1 - width) to spot * (1 + width)
+        points: grid size
+        """
+        self.model = model
+        self.width = width
+        self.points = points
+        self.rows = {}
+        self.strikes = np.empty(0)
+        self.is_call = np.empty(0, dtype=bool)
+        self.recenters = 0
+        self.center(spot)
+
+    def center(self, spot: float):
+        self.grid = np.linspace(spot * (1 - self.width), spot * (1 + self.width), self.points)
+        self.step = self.grid[1] - self.grid[0]
+        self.curves = self.model.theos(strikes=self.strikes[:, None], spot=self.grid[None, :], rights=self.is_call[:, None])
+
+    def add(self, strike: float, is_call: bool) -> int:
+        self.rows[(strike, is_call)] = len(self.rows)
+        self.strikes = np.append(self.strikes, strike)
+        self.is_call = np.append(self.is_call, is_call)
+        curve = self.model.theos(strikes=strike, spot=self.grid, rights=is_call)
+        self.curves = np.vstack([self.curves, curve[None, :]])
+        return self.rows[(strike, is_call)]
+
+    def theo(self, strike: float, is_call: bool, spot: float) -> float:
+        row = self.rows.get((strike, is_call))
+        if row is None:
+            row = self.add(strike, is_call)
+        position = (spot - self.grid[0]) / self.step
+        if not 0 <= position < self.points - 1:
+            self.recenters += 1
+            self.center(spot)
+            position = (spot - self.grid[0]) / self.step
+        i = int(position)
+        weight = position - i
+        return self.curves[row, i] * (1 - weight) + self.curves[row, i + 1] * weight
+
+
+class LiveSignalService:
+    def __init__(self, model: Model, spot: float, edge: float=0.0, width: float=0.1, points: int=2001):
+        """
+        Streams KDE edge signals over quote ticks.
+
+        Theos only depend on (strike, spot, right), so they come from TheoCurves and are only recomputed when the model
+        is refreshed or spot leaves the cached grid; bid/ask updates cost an interpolation and two comparisons.
+
+        Arguments:
+        model: fitted Model
+        spot: initial underlying price
+        edge: theo has to clear the ask (bid) by this much to go long (short)
+        width, points: spot grid, see TheoCurves
+        """
+        self.edge = edge
+        self.width = width
+        self.points = points
+        # a histogram rather than every latency, so a long session doesn't grow memory
+        self.latency = Histogram(TICK_LATENCY_BUCKETS)
+        self.max_latency_ns = 0
+        self.refresh(model, spot)
+
+    def refresh(self, model: Model=None, spot: float=None):
+        """
+        Swaps in a refitted model (or recenters on spot) and rebuilds every cached curve
+        """
+        model = model if model is not None else self.curves.model
+        spot = spot if spot is not None else (self.curves.grid[0] + self.curves.grid[-1]) / 2
+        contracts = list(self.curves.rows) if hasattr(self, "curves") else []
+        self.curves = TheoCurves(model, spot, width=self.width, points=self.points)
+        for strike, is_call in contracts:
+            self.curves.add(strike, is_call)
+
+    def on_tick(self, tick) -> np.void:
+        """
+        Returns:
+        SIGNAL_DTYPE record with direction +1 for long, 0 for no signal, -1 for short
+        """
+        start = time.perf_counter_ns()
+        signal = np.zeros((), dtype=SIGNAL_DTYPE)
+        for name in TICK_DTYPE.names:
+            signal[name] = tick[name]
+        if np.isfinite(tick["spot"]):
+            theo = self.curves.theo(float(tick["strike"]), bool(tick["is_call"]), float(tick["spot"]))
+            signal["theo"] = theo
+            signal["direction"] = int(theo > tick["ask"] + self.edge) - int(theo < tick["bid"] - self.edge)
+        else:
+            signal["theo"] = np.nan
+        signal["latency_ns"] = time.perf_counter_ns() - start
+        self.latency.observe(int(signal["latency_ns"]) / 1e9)
+        self.max_latency_ns = max(self.max_latency_ns, int(signal["latency_ns"]))
+        return signal
+
+    async def signals(self, ticks, only_trades: bool=False):
+        """
+        Async generator of signals for an (async or plain) iterable of TICK_DTYPE ticks
+
+        Arguments:
+        only_trades: skip ticks without a signal
+        """
+        if hasattr(ticks, "__aiter__"):
+            async for tick in ticks:
+                signal = self.on_tick(tick)
+                if not only_trades or signal["direction"] != 0:
+                    yield signal
+        else:
+            for tick in ticks:
+                signal = self.on_tick(tick)
+                if not only_trades or signal["direction"] != 0:
+                    yield signal
+                # let other tasks run between ticks
+                await asyncio.sleep(0)
+
+    def latency_stats(self) -> dict:
+        """
+        Per-tick processing latency in microseconds, percentiles are upper bounds of TICK_LATENCY_BUCKETS
+        """
+        if self.latency.count == 0:
+            return {"ticks": 0}
+        latency = self.latency
+        return {"ticks": latency.count, "mean_us": latency.sum / latency.count * 1e6, "p50_us": latency.quantile(0.5) * 1e6, "p99_us": latency.quantile(0.99) * 1e6, "max_us": self.max_latency_ns / 1000, "recenters": self.curves.recenters}
@@ -0,0 +1,123 @@
+import os
+import datetime as dt
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+
+from file_io import atomic_write
+from dates import datetime_to_days
+
+_dtype = np.dtype([("date", "<i8"), ("close", "<f8")])
+
+
+class MarketDataStore:
+    def __init__(self, data_dir: str=None, offline: bool=False, history_start: dt.date=dt.date(2000, 1, 1)):
+        """
+        Local store of daily adjusted closes for underlyings and indices, one memory-mapped .npy file per symbol.
+
+        Symbols are loaded lazily on first use. Unless offline, a symbol is topped up once per session by downloading
+        only the days after the last stored close; if the download fails the local file is used as is.
+
+        Arguments:
+        data_dir: directory for .npy files (defaults to $MARKET_DATA_DIR or ~/.cache/market_data)
+        offline: never download, only read local files
+        history_start: first date downloaded for symbols that aren't stored yet
+        """
+        if data_dir is None:
+            data_dir = os.environ.get("MARKET_DATA_DIR", os.path.expanduser("~/.cache/market_data"))
+        self.data_dir = data_dir
+        self.offline = offline
+        self.history_start = history_start
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _path(self, symbol: str) -> str:
+        return os.path.join(self.data_dir, f"{symbol.replace('^', '_')}.npy")
+
+    def _read(self, symbol: str) -> np.ndarray:
+        path = self._path(symbol)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=_dtype)
+        return np.load(path, mmap_mode="r")
+
+    def _write(self, symbol: str, data: np.ndarray):
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = self._path(symbol)
+        with atomic_write(path) as f:
+            np.save(f, data)
+
+    @staticmethod
+    def _download(symbol: str, start: dt.date) -> np.ndarray:
+        import yfinance as yf
+        closes = yf.download([symbol], start=start, end=dt.date.today() + dt.timedelta(days=1), progress=False, auto_adjust=False)['Adj Close']
+        if isinstance(closes, pd.DataFrame):
+            closes = closes.iloc[:, 0]
+        closes = closes.dropna()
+        data = np.empty(closes.size, dtype=_dtype)
+        data["date"] = datetime_to_days(closes.index)
+        data["close"] = closes.values
+        return data
+
+    def update(self, symbol: str) -> np.ndarray:
+        """
+        Appends closes after the last stored date. If the last stored close no longer matches the source (e.g. the
+        adjusted history changed after a split or dividend) the whole history is downloaded again.
+        """
+        data = self._read(symbol)
+        start = self.history_start if data.size == 0 else dt.date(1970, 1, 1) + dt.timedelta(days=int(data["date"][-1]))
+        try:
+            new = self._download(symbol, start)
+        except Exception as e:
+            warnings.warn(f"could not update {symbol}, using local data: {e}")
+            return data
+        # today's close isn't final yet
+        new = new[new["date"] < np.datetime64(dt.date.today(), "D").astype(np.int64)]
+        if data.size:
+            overlap = new[new["date"] == data["date"][-1]]
+            if overlap.size and not np.isclose(overlap["close"][0], data["close"][-1], rtol=1e-6):
+                new = self._download(symbol, min(self.history_start, dt.date(1970, 1, 1) + dt.timedelta(days=int(data["date"][0]))))
+                new = new[new["date"] < np.datetime64(dt.date.today(), "D").astype(np.int64)]
+                data = np.empty(0, dtype=_dtype)
+            new = new[new["date"] > data["date"][-1]] if data.size else new
+        if new.size:
+            data = np.concatenate([data, new])
+            self._write(symbol, data)
+            data = self._read(symbol)
+        return data
+
+    def _get(self, symbol: str) -> np.ndarray:
+        with self._lock:
+            if symbol not in self._loaded:
+                self._loaded[symbol] = self._read(symbol) if self.offline else self.update(symbol)
+            return self._loaded[symbol]
+
+    def closes(self, symbol: str, start_date: dt.date=None, end_date: dt.date=None) -> pd.Series:
+        """
+        Returns:
+        pd.Series of adjusted closes indexed by date, between start_date and end_date inclusive
+        """
+        data = self._get(symbol)
+        lo = 0 if start_date is None else np.searchsorted(data["date"], np.datetime64(start_date, "D").astype(np.int64))
+        hi = data.size if end_date is None else np.searchsorted(data["date"], np.datetime64(end_date, "D").astype(np.int64), side="right")
+        window = data[lo:hi]
+        index = pd.DatetimeIndex(window["date"].astype("datetime64[D]"), name="Date")
+        return pd.Series(window["close"], index=index, name=symbol)
+
+    def panel(self, symbols: list[str], start_date: dt.date=None, end_date: dt.date=None) -> pd.DataFrame:
+        """
+        Closes of several symbols aligned on date, NaN where a symbol has no close
+        """
+        return pd.concat([self.closes(symbol, start_date, end_date) for symbol in symbols], axis=1)
+
+
+_store = None
+
+def get_store() -> MarketDataStore:
+    """
+    Process-wide store shared by Engine, Model and distribution
+    """
+    global _store
+    if _store is None:
+        _store = MarketDataStore(offline=os.environ.get("MARKET_DATA_OFFLINE", "0") == "1")
+    return _store
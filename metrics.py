@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# seconds, roughly x2.5 apart from 0.1ms to 60s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bucket bound below which a fraction q of the observations fall
+        """
+        if self.count == 0:
+            return float("nan")
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            if total >= q * self.count:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self, enabled: bool=True):
+        """
+        In-process registry of counters and latency histograms, labelled by keyword arguments.
+
+        Recording is a dict lookup and an add under a lock, and a no-op when disabled. Stage timings go through
+        timer(), e.g. `with metrics.timer("stage_seconds", stage="iv_solve"):`.
+
+        Arguments:
+        enabled: record anything at all
+        """
+        self.enabled = enabled
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def to_dict(self) -> dict:
+        """
+        Snapshot of every counter and histogram, plus hit rates for each *_hits_total / *_misses_total pair
+        """
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{
+                "name": name,
+                "labels": dict(labels),
+                "count": histogram.count,
+                "sum": histogram.sum,
+                "p50": histogram.quantile(0.5),
+                "p99": histogram.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts)),
+            } for (name, labels), histogram in sorted(self._histograms.items())]
+            hit_rates = []
+            for (name, labels), hits in sorted(self._counters.items()):
+                if name.endswith("_hits_total"):
+                    prefix = name[:-len("_hits_total")]
+                    misses = self._counters.get((f"{prefix}_misses_total", labels), 0)
+                    hit_rates.append({"name": f"{prefix}_hit_rate", "labels": dict(labels), "value": hits / (hits + misses) if hits + misses else 0.0})
+        return {"counters": counters, "histograms": histograms, "hit_rates": hit_rates}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self) -> str:
+        """
+        Prometheus text exposition format
+        """
+        def format_labels(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in list(labels) + list(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = None
+
+def get_metrics() -> Metrics:
+    """
+    Process-wide registry used by ThetaDataAPI, Model, Engine and the pricing functions, disabled with METRICS=0
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(enabled=os.environ.get("METRICS", "1") != "0")
+    return _metrics
@@ -0,0 +1,220 @@
+import os
+import math
+import hashlib
+import numpy as np
+import pandas as pd
+
+from metrics import get_metrics
+from file_io import atomic_write
+from dates import datetime_to_days
+
+
+def kernel_sum(grid: np.ndarray, samples: np.ndarray, bandwidth: float, chunk_size: int=256) -> np.ndarray:
+    """
+    Unnormalized gaussian kernel sum over the samples, evaluated on the grid (chunked to bound memory)
+    """
+    total = np.zeros(grid.size)
+    for i in range(0, samples.size, chunk_size):
+        z = (grid[:, None] - samples[None, i:i + chunk_size]) / bandwidth
+        total += np.exp(-0.5 * z * z).sum(axis=1)
+    return total
+
+def scott_bandwidth(samples: np.ndarray) -> float:
+    # same as gaussian_kde(samples).factor * std for 1-D data
+    return float(np.std(samples, ddof=1) * samples.size ** (-1 / 5))
+
+def cv_bandwidth(samples: np.ndarray) -> float:
+    """
+    Bandwidth chosen by time series cross-validation over np.logspace(-3, 0, 50), as in the notebook model
+    """
+    from sklearn.model_selection import GridSearchCV, TimeSeriesSplit
+    from sklearn.neighbors import KernelDensity
+    grid = GridSearchCV(estimator=KernelDensity(kernel='gaussian'), param_grid={'bandwidth': np.logspace(-3, 0, 50)}, cv=TimeSeriesSplit(n_splits=5))
+    grid.fit(samples.reshape(-1, 1))
+    return float(grid.best_estimator_.bandwidth_)
+
+
+class FittedDensity:
+    def __init__(self, dates: np.ndarray, samples: np.ndarray, bandwidth: float, grid: np.ndarray, kernels: np.ndarray, cv_date: int=-1):
+        """
+        Gaussian KDE of returns with a fixed bandwidth, evaluated on a grid.
+
+        Arguments:
+        dates: sample dates as days since epoch (int64)
+        samples: log returns
+        bandwidth: kernel standard deviation
+        grid: log-return grid
+        kernels: unnormalized kernel sum on the grid (see kernel_sum), kept so samples can be added/removed cheaply
+        cv_date: last date at which the bandwidth was cross-validated, -1 if it wasn't
+        """
+        self.dates = dates
+        self.samples = samples
+        self.bandwidth = bandwidth
+        self.grid = grid
+        self.kernels = kernels
+        self.cv_date = cv_date
+
+    @property
+    def density(self) -> np.ndarray:
+        return self.kernels / (self.samples.size * self.bandwidth * math.sqrt(2 * math.pi))
+
+    @property
+    def kde(self):
+        """
+        scipy gaussian_kde with the same bandwidth, built on demand
+        """
+        from scipy.stats import gaussian_kde
+        return gaussian_kde(self.samples, bw_method=self.bandwidth / np.std(self.samples, ddof=1))
+
+    def save(self, path: str):
+        with atomic_write(path) as f:
+            np.savez(f, dates=self.dates, samples=self.samples, bandwidth=self.bandwidth, grid=self.grid, kernels=self.kernels, cv_date=self.cv_date)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as npz:
+            return cls(npz["dates"], npz["samples"], float(npz["bandwidth"]), npz["grid"], npz["kernels"], int(npz["cv_date"]))
+
+
+class ModelStore:
+    def __init__(self, store_dir: str=None, grid: np.ndarray=None, cv_refresh_days: int=21, persist: bool=True, max_windows: int=8):
+        """
+        Memoizes fitted return densities in memory and on disk.
+
+        Entries are keyed on (root, start, end, bandwidth, regime). When a window isn't stored yet but an earlier
+        window of the same (root, bandwidth, regime) is, and the new window only rolls forward, the stored kernel sum
+        is updated by adding the new days and removing the dropped ones instead of refitting from scratch. Entries
+        whose overlapping returns no longer match the data (e.g. revised closes) are refit. Only the latest window of
+        each (root, bandwidth, regime) is kept in memory, and at most max_windows of them on disk.
+
+        Arguments:
+        store_dir: directory for .npz entries (defaults to $MODEL_STORE_DIR or ~/.cache/kde_models)
+        grid: log-return grid densities are evaluated on
+        cv_refresh_days: for cross-validated bandwidths, calendar days after which CV is rerun on a rolled window
+        persist: False to keep entries in memory only (e.g. for throwaway per-day fits in sweeps)
+        max_windows: windows kept on disk per (root, bandwidth, regime), the ones ending earliest are deleted first
+        """
+        if store_dir is None:
+            store_dir = os.environ.get("MODEL_STORE_DIR", os.path.expanduser("~/.cache/kde_models"))
+        self.store_dir = store_dir
+        self.grid = grid if grid is not None else np.linspace(-2, 2, 2**13 + 1)
+        self.cv_refresh_days = cv_refresh_days
+        self.persist = persist
+        self.max_windows = max_windows
+        self._memory = {}
+
+    def _lineage_dir(self, root: str, bandwidth, regime) -> str:
+        grid_id = hashlib.sha1(self.grid.tobytes()).hexdigest()[:8]
+        return os.path.join(self.store_dir, f"{root}_{bandwidth}_{regime}_{grid_id}")
+
+    def fit(self, root: str, returns: pd.Series, bandwidth=None, regime=None) -> FittedDensity:
+        """
+        Arguments:
+        root: ticker the returns belong to
+        returns: log returns indexed by date, NaNs are dropped
+        bandwidth: kernel standard deviation, None for Scott's rule or "cv" for cross-validation
+        regime: optional label (e.g. VIX regime bucket) the returns were selected with
+
+        Returns:
+        FittedDensity for the window
+        """
+        with get_metrics().timer("stage_seconds", stage="density_fit"):
+            return self._fit_cached(root, returns, bandwidth, regime)
+
+    def _fit_cached(self, root: str, returns: pd.Series, bandwidth=None, regime=None) -> FittedDensity:
+        returns = returns.dropna()
+        dates = datetime_to_days(returns.index)
+        samples = returns.values.astype(np.float64)
+        bandwidth_key = "scott" if bandwidth is None else bandwidth
+        lineage = self._lineage_dir(root, bandwidth_key, regime)
+        name = f"{dates[0]}_{dates[-1]}.npz" if dates.size else "empty.npz"
+        path = os.path.join(lineage, name)
+
+        fitted = self._memory.get(path)
+        if fitted is None and self.persist and os.path.exists(path):
+            fitted = FittedDensity.load(path)
+        if fitted is not None and np.array_equal(fitted.dates, dates) and np.array_equal(fitted.samples, samples):
+            self._remember(lineage, path, fitted)
+            return fitted
+
+        fitted = self._roll_forward(lineage, dates, samples, bandwidth)
+        if fitted is None:
+            fitted = self._fit(dates, samples, bandwidth)
+        if self.persist:
+            os.makedirs(lineage, exist_ok=True)
+            fitted.save(path)
+            self._prune(lineage, keep=name)
+        self._remember(lineage, path, fitted)
+        return fitted
+
+    def _remember(self, lineage: str, path: str, fitted: FittedDensity):
+        # only the latest window is rolled forward from memory, older ones are reloaded from disk if ever needed
+        for stale in [entry for entry in self._memory if os.path.dirname(entry) == lineage and entry != path]:
+            del self._memory[stale]
+        self._memory[path] = fitted
+
+    def _prune(self, lineage: str, keep: str):
+        """
+        Deletes the windows of a lineage ending earliest until at most max_windows are left, sparing keep
+        """
+        windows = []
+        for entry in os.listdir(lineage):
+            window = self._window(entry)
+            if window is not None and entry != keep:
+                windows.append((window[1], window[0], entry))
+        for _, _, entry in sorted(windows)[:max(len(windows) + 1 - self.max_windows, 0)]:
+            try:
+                os.remove(os.path.join(lineage, entry))
+            except FileNotFoundError:
+                # pruned by another process first
+                pass
+
+    @staticmethod
+    def _window(entry: str):
+        """
+        (start, end) days of a stored window's file name, None for any other file
+        """
+        start, _, end = entry[:-len(".npz")].partition("_")
+        if entry.endswith(".npz") and start.lstrip("-").isdigit() and end.lstrip("-").isdigit():
+            return (int(start), int(end))
+        return None
+
+    def _fit(self, dates: np.ndarray, samples: np.ndarray, bandwidth) -> FittedDensity:
+        cv_date = -1
+        if bandwidth is None:
+            h = scott_bandwidth(samples)
+        elif bandwidth == "cv":
+            h = cv_bandwidth(samples)
+            cv_date = int(dates[-1])
+        else:
+            h = float(bandwidth)
+        return FittedDensity(dates, samples, h, self.grid, kernel_sum(self.grid, samples, h), cv_date)
+
+    def _roll_forward(self, lineage: str, dates: np.ndarray, samples: np.ndarray, bandwidth):
+        """
+        Updates the latest stored window that starts no later and ends no later than the new one, if any
+        """
+        if bandwidth is None or dates.size == 0:
+            # Scott's rule changes with every sample, so the kernels can't be reused
+            return None
+        entries = {os.path.basename(path) for path in self._memory if os.path.dirname(path) == lineage}
+        if self.persist and os.path.isdir(lineage):
+            entries.update(os.listdir(lineage))
+        candidates = []
+        for entry in entries:
+            window = self._window(entry)
+            if window is not None and window[0] <= dates[0] <= window[1] <= dates[-1]:
+                candidates.append((window[1], entry))
+        if not candidates:
+            return None
+        path = os.path.join(lineage, max(candidates)[1])
+        old = self._memory.get(path) or FittedDensity.load(path)
+        if bandwidth == "cv" and dates[-1] - old.cv_date > self.cv_refresh_days:
+            return None
+        # the overlap has to match exactly, otherwise history was revised
+        keep_old = old.dates >= dates[0]
+        overlap = dates <= old.dates[-1]
+        if not (np.array_equal(old.dates[keep_old], dates[overlap]) and np.array_equal(old.samples[keep_old], samples[overlap])):
+            return None
+        kernels = old.kernels + kernel_sum(self.grid, samples[~overlap], old.bandwidth) - kernel_sum(self.grid, old.samples[~keep_old], old.bandwidth)
+        return FittedDensity(dates, samples, old.bandwidth, self.grid, kernels, old.cv_date)
@@ -0,0 +1,134 @@
+import numpy as np
+
+from ThetaDataClient import Right
+from dates import yyyymmdd_to_days
+
+# int8 codes used for rights inside OptionChain
+CALL = np.int8(0)
+PUT = np.int8(1)
+RIGHT_CODES = {Right.CALL: CALL, Right.PUT: PUT}
+
+
+class OptionChain:
+    def __init__(self, root: str, rights: np.ndarray, expirations: np.ndarray, dates: np.ndarray, strikes: np.ndarray, fields: dict):
+        """
+        Array-backed option chain.
+
+        Every field is one contiguous float64 array of shape (rights, expirations, dates, strikes), NaN where a contract
+        has no data. Slicing by right, expiration, date or strike range returns views of the same memory.
+
+        Arguments:
+        root: underlying ticker
+        rights: int8 right codes (CALL / PUT)
+        expirations: int64 expirations in days since epoch, sorted
+        dates: int64 quote dates in days since epoch, sorted
+        strikes: float64 strikes in dollars, sorted
+        fields: field name to array of shape (len(rights), len(expirations), len(dates), len(strikes))
+        """
+        self.root = root
+        self.rights = np.asarray(rights, dtype=np.int8)
+        self.expirations = np.asarray(expirations, dtype=np.int64)
+        self.dates = np.asarray(dates, dtype=np.int64)
+        self.strikes = np.asarray(strikes, dtype=np.float64)
+        self.fields = fields
+        self._right_index = {int(right): i for i, right in enumerate(self.rights)}
+        self._expiration_index = {int(exp): i for i, exp in enumerate(self.expirations)}
+        self._date_index = {int(date): i for i, date in enumerate(self.dates)}
+        self._strike_index = {float(strike): i for i, strike in enumerate(self.strikes)}
+
+    @property
+    def shape(self) -> tuple:
+        return (self.rights.size, self.expirations.size, self.dates.size, self.strikes.size)
+
+    def __getitem__(self, field: str) -> np.ndarray:
+        return self.fields[field]
+
+    def right_index(self, right: Right) -> int:
+        return self._right_index[int(RIGHT_CODES.get(right, right))]
+
+    def expiration_index(self, exp: int) -> int:
+        return self._expiration_index[int(exp)]
+
+    def date_index(self, date: int) -> int:
+        return self._date_index[int(date)]
+
+    def strike_index(self, strike: float) -> int:
+        return self._strike_index[float(strike)]
+
+    def _view(self, rights=slice(None), expirations=slice(None), dates=slice(None), strikes=slice(None)):
+        fields = {name: values[rights, expirations, dates, strikes] for name, values in self.fields.items()}
+        return OptionChain(self.root, self.rights[rights], self.expirations[expirations], self.dates[dates], self.strikes[strikes], fields)
+
+    def for_right(self, right: Right):
+        i = self.right_index(right)
+        return self._view(rights=slice(i, i + 1))
+
+    def for_expiration(self, exp: int):
+        i = self.expiration_index(exp)
+        return self._view(expirations=slice(i, i + 1))
+
+    def on_date(self, date: int):
+        i = self.date_index(date)
+        return self._view(dates=slice(i, i + 1))
+
+    def between_dates(self, start: int, end: int):
+        return self._view(dates=slice(np.searchsorted(self.dates, start), np.searchsorted(self.dates, end, side="right")))
+
+    def strike_range(self, low: float, high: float):
+        return self._view(strikes=slice(np.searchsorted(self.strikes, low), np.searchsorted(self.strikes, high, side="right")))
+
+    def moneyness(self, spot: float, low: float, high: float):
+        """
+        Strikes with low <= K / spot <= high
+        """
+        return self.strike_range(low * spot, high * spot)
+
+    def mid(self, bid: str="bid", ask: str="ask") -> np.ndarray:
+        return (self.fields[bid] + self.fields[ask]) / 2
+
+    def time_to_expiry(self) -> np.ndarray:
+        """
+        (expirations, dates) array of years to expiry, NaN after expiry
+        """
+        days = (self.expirations[:, None] - self.dates[None, :]).astype(np.float64)
+        return np.where(days >= 0, days / 365, np.nan)
+
+    def is_call(self) -> np.ndarray:
+        return self.rights == CALL
+
+    @classmethod
+    def from_bulk(cls, root: str, exp, dates, chains: dict, points: list[str]):
+        """
+        Builds a one-expiration chain from WrapperClient.assemble_bulk output (ThetaData units)
+
+        Arguments:
+        exp: expiration as YYYYMMDD
+        dates: quote dates as YYYYMMDD
+        chains: dict mapping Right to (strikes in 1/1000 dollars, {point: (dates x strikes) array})
+        """
+        rights = list(chains)
+        strikes = np.unique(np.concatenate([np.asarray(chains[right][0], dtype=np.int64) for right in rights] + [np.empty(0, dtype=np.int64)]))
+        fields = {point: np.full((len(rights), 1, len(dates), strikes.size), np.nan) for point in points}
+        for i, right in enumerate(rights):
+            right_strikes, data = chains[right]
+            cols = np.searchsorted(strikes, np.asarray(right_strikes, dtype=np.int64))
+            for point in points:
+                fields[point][i, 0][:, cols] = data[point]
+        return cls(root, [RIGHT_CODES[right] for right in rights], yyyymmdd_to_days([exp]), yyyymmdd_to_days(dates), strikes / 1000, fields)
+
+    @classmethod
+    def merge(cls, chains: list):
+        """
+        Stacks chains of the same root along expirations on the union of their rights, dates and strikes
+        """
+        rights = np.unique(np.concatenate([chain.rights for chain in chains]))
+        expirations = np.unique(np.concatenate([chain.expirations for chain in chains]))
+        dates = np.unique(np.concatenate([chain.dates for chain in chains]))
+        strikes = np.unique(np.concatenate([chain.strikes for chain in chains]))
+        names = set.intersection(*(set(chain.fields) for chain in chains))
+        fields = {name: np.full((rights.size, expirations.size, dates.size, strikes.size), np.nan) for name in names}
+        for chain in chains:
+            index = np.ix_(np.searchsorted(rights, chain.rights), np.searchsorted(expirations, chain.expirations), np.searchsorted(dates, chain.dates), np.searchsorted(strikes, chain.strikes))
+            for name in names:
+                fields[name][index] = chain.fields[name]
+        return cls(chains[0].root, rights, expirations, dates, strikes, fields)
@@ -0,0 +1,220 @@
+import os
+import json
+import hashlib
+import threading
+import datetime as dt
+from collections import OrderedDict
+
+import numpy as np
+
+from file_io import atomic_write
+
+
+class ResponseCache:
+    def __init__(self, cache_dir: str=None, max_bytes: int=2 * 1024**3, enabled: bool=True, refresh: bool=False):
+        """
+        On-disk LRU cache of decoded ThetaData responses, stored column-wise in .npz files
+
+        Arguments:
+        cache_dir: directory for cache files (defaults to $THETADATA_CACHE_DIR or ~/.cache/thetadata)
+        max_bytes: total size on disk before least recently used entries are evicted
+        enabled: False to bypass the cache entirely
+        refresh: True to always re-download and overwrite existing entries
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get("THETADATA_CACHE_DIR", os.path.expanduser("~/.cache/thetadata"))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def _load_index(self):
+        # least recently used first, ordered by mtime which get/put bump
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = [e for e in os.scandir(self.cache_dir) if e.name.endswith(".npz")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        self._index = OrderedDict((e.path, e.stat().st_size) for e in entries)
+        self._size = sum(self._index.values())
+
+    @staticmethod
+    def key(url: str, params: dict=None) -> str:
+        raw = url + "|" + json.dumps(params or {}, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    @staticmethod
+    def cacheable(endpoint: str, params: dict=None) -> bool:
+        """
+        Only historical endpoints whose range ends before today are immutable
+        """
+        if not endpoint.startswith(("hist/", "bulk_hist/")):
+            return False
+        query = dict(p.split("=", 1) for p in endpoint.partition("?")[2].split("&") if "=" in p)
+        query.update({k: str(v) for k, v in (params or {}).items()})
+        end_date = query.get("end_date", query.get("start_date"))
+        return end_date is not None and end_date < dt.date.today().strftime("%Y%m%d")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key: str):
+        if not self.enabled or self.refresh:
+            return None
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str):
+        if self._index is None:
+            self._load_index()
+        path = self._path(key)
+        if path not in self._index:
+            self.misses += 1
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                data = decode(npz)
+        except (OSError, ValueError, KeyError):
+            self._remove(path)
+            self.misses += 1
+            return None
+        os.utime(path)
+        self._index.move_to_end(path)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: dict):
+        if not self.enabled:
+            return
+        arrays = encode(data)
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            path = self._path(key)
+            with atomic_write(path) as f:
+                np.savez_compressed(f, **arrays)
+            self._size -= self._index.pop(path, 0)
+            self._index[path] = os.path.getsize(path)
+            self._size += self._index[path]
+            self._evict()
+
+    def _remove(self, path: str):
+        self._size -= self._index.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._index) > 1:
+            self._remove(next(iter(self._index)))
+
+    def clear(self):
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            for path in list(self._index):
+                self._remove(path)
+
+
+def _columns(rows: list, prefix: str, arrays: dict) -> bool:
+    """
+    Stores a list of equal-length rows as one array per column, False if the rows aren't rectangular and typed
+    """
+    width = len(rows[0]) if rows else 0
+    if any(not isinstance(row, list) or len(row) != width for row in rows):
+        return False
+    for i, column in enumerate(zip(*rows)):
+        array = np.array(column)
+        if array.dtype == object or (array.dtype.kind == "U" and not all(isinstance(v, str) for v in column)):
+            return False
+        arrays[f"{prefix}{i}"] = array
+    arrays[f"{prefix}width"] = np.array(width)
+    arrays[f"{prefix}length"] = np.array(len(rows))
+    return True
+
+def _rows(npz, prefix: str) -> list:
+    width = int(npz[f"{prefix}width"])
+    if width == 0:
+        return [[] for _ in range(int(npz[f"{prefix}length"]))]
+    return [list(row) for row in zip(*(npz[f"{prefix}{i}"].tolist() for i in range(width)))]
+
+def encode(data: dict) -> dict:
+    """
+    Converts a ThetaData JSON response into npz arrays.
+
+    Row responses ([[...], ...]) are stored column-wise, bulk responses ([{"contract", "ticks"}, ...]) store the
+    contract fields as columns plus all ticks concatenated with offsets, and anything else falls back to JSON.
+    Responses already decoded into columns by json_stream are stored as is.
+    """
+    arrays = {"header": np.array(json.dumps(data.get("header")))}
+    response = data.get("response")
+    if isinstance(response, dict):
+        # already columnar (decoded with json_stream)
+        arrays["kind"] = np.array("columns")
+        arrays["names"] = np.array(list(response), dtype=str)
+        for i, column in enumerate(response.values()):
+            arrays[f"col{i}"] = column
+        if "contracts" in data:
+            keys = sorted(data["contracts"][0]) if data["contracts"] else []
+            _columns([[c[k] for k in keys] for c in data["contracts"]], "contract", arrays)
+            arrays["contract_keys"] = np.array(keys, dtype=str)
+            arrays["offsets"] = data["offsets"]
+        return arrays
+    if isinstance(response, np.ndarray):
+        arrays["kind"] = np.array("array")
+        arrays["values"] = response
+        return arrays
+    if isinstance(response, list) and response and all(isinstance(r, list) for r in response):
+        if _columns(response, "col", arrays):
+            arrays["kind"] = np.array("rows")
+            return arrays
+        arrays = {"header": arrays["header"]}
+    elif isinstance(response, list) and response and all(isinstance(r, dict) and set(r) == {"contract", "ticks"} for r in response):
+        keys = sorted(response[0]["contract"])
+        if all(sorted(r["contract"]) == keys for r in response):
+            ticks = [tick for r in response for tick in r["ticks"]]
+            contracts = [[r["contract"][k] for k in keys] for r in response]
+            if _columns(contracts, "contract", arrays) and _columns(ticks, "tick", arrays):
+                arrays["kind"] = np.array("bulk")
+                arrays["contract_keys"] = np.array(keys)
+                arrays["offsets"] = np.cumsum([0] + [len(r["ticks"]) for r in response])
+                return arrays
+            arrays = {"header": arrays["header"]}
+    elif isinstance(response, list):
+        array = np.array(response)
+        if array.ndim == 1 and array.dtype != object and (array.dtype.kind != "U" or all(isinstance(v, str) for v in response)):
+            arrays["kind"] = np.array("list")
+            arrays["values"] = array
+            return arrays
+    arrays["kind"] = np.array("json")
+    arrays["response"] = np.array(json.dumps(response))
+    return arrays
+
+def decode(npz) -> dict:
+    header = json.loads(str(npz["header"]))
+    kind = str(npz["kind"])
+    if kind == "rows":
+        response = _rows(npz, "col")
+    elif kind == "bulk":
+        keys = npz["contract_keys"].tolist()
+        contracts = _rows(npz, "contract")
+        ticks = _rows(npz, "tick")
+        offsets = npz["offsets"].tolist()
+        response = [{"contract": dict(zip(keys, contract)), "ticks": ticks[offsets[i]:offsets[i+1]]} for i, contract in enumerate(contracts)]
+    elif kind == "columns":
+        response = {name: npz[f"col{i}"] for i, name in enumerate(npz["names"].tolist())}
+        if "offsets" in npz:
+            keys = npz["contract_keys"].tolist()
+            contracts = [dict(zip(keys, contract)) for contract in _rows(npz, "contract")]
+            return {"header": header, "response": response, "contracts": contracts, "offsets": npz["offsets"]}
+    elif kind == "array":
+        response = npz["values"]
+    elif kind == "list":
+        response = npz["values"].tolist()
+    else:
+        response = json.loads(str(npz["response"]))
+    return {"header": header, "response": response}
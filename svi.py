@@ -0,0 +1,246 @@
+import numpy as np
+
+from ThetaDataClient import Right
+from black_scholes import bs_price, bs_iv_chain
+from metrics import get_metrics
+
+# raw SVI parameters per slice: a, b, rho, m, sigma
+NUM_PARAMS = 5
+
+def raw_svi(k, a, b, rho, m, sigma):
+    """
+    Raw SVI total implied variance w(k) = a + b (rho (k - m) + sqrt((k - m)^2 + sigma^2)) and its first two
+    derivatives in log-moneyness k
+    """
+    x = k - m
+    root = np.sqrt(x * x + sigma * sigma)
+    w = a + b * (rho * x + root)
+    dw = b * (rho + x / root)
+    d2w = b * sigma * sigma / root**3
+    return (w, dw, d2w)
+
+def ssvi_to_raw(theta, rho, phi):
+    """
+    Raw SVI parameters of the SSVI slices w(k) = theta / 2 (1 + rho phi k + sqrt((phi k + rho)^2 + 1 - rho^2))
+    """
+    theta, phi = np.asarray(theta, dtype=np.float64), np.asarray(phi, dtype=np.float64)
+    return np.stack([theta / 2 * (1 - rho * rho), theta * phi / 2, np.full(theta.shape, rho), -rho / phi, np.sqrt(1 - rho * rho) / phi], axis=-1)
+
+def power_law_phi(theta, eta, gamma):
+    return eta / (theta**gamma * (1 + theta) ** (1 - gamma))
+
+def butterfly_g(k, w, dw, d2w):
+    """
+    Gatheral's g(k), the slice is free of butterfly arbitrage where g >= 0
+    """
+    return (1 - k * dw / (2 * w)) ** 2 - dw * dw / 4 * (1 / w + 1 / 4) + d2w / 2
+
+
+class SVISurface:
+    def __init__(self, expiries: np.ndarray, params: np.ndarray, S: float, r: float=0):
+        """
+        Implied volatility surface of one date made of raw SVI slices in log-moneyness k = log(K / F), F = S e^(rT).
+
+        Between expiries total variance is interpolated linearly in T at fixed k (which keeps calendar spreads
+        non-negative when the slices don't cross), before the first expiry it goes linearly to 0 and after the last
+        it is extrapolated at constant implied vol. All queries are closed form and broadcast over K and T.
+
+        Arguments:
+        expiries: (E,) sorted times to expiry in years
+        params: (E, 5) raw SVI parameters (a, b, rho, m, sigma) per expiry
+        S: spot price
+        r: risk-free rate
+        """
+        self.expiries = np.asarray(expiries, dtype=np.float64)
+        self.params = np.asarray(params, dtype=np.float64)
+        self.S = S
+        self.r = r
+        # a zero-variance slice at T = 0 so short expiries interpolate towards it
+        self._t = np.concatenate(([0.0], self.expiries))
+        self._params = np.vstack([[0.0, 0.0, 0.0, 0.0, 1.0], self.params])
+
+    @classmethod
+    def fit(cls, strikes, iv, expiries, S: float, r: float=0, kind: str="ssvi", weights=None):
+        """
+        Fits every expiry of a date at once with scipy.optimize.least_squares on implied vol.
+
+        "ssvi" fits one SSVI surface (shared rho, power-law phi(theta) with eta, gamma, and non-decreasing ATM total
+        variance theta per expiry) with eta (1 + |rho|) <= 2 enforced, which makes it free of butterfly and calendar
+        arbitrage by construction. "svi" starts from that fit and refines five raw SVI parameters per expiry jointly
+        (block-sparse Jacobian); it tracks each smile more closely but is only checked, not guaranteed, to be
+        arbitrage free (see check_arbitrage).
+
+        Arguments:
+        strikes: (K,) or (E, K) strikes
+        iv: (E, K) implied vols, NaN where there is no quote
+        expiries: (E,) times to expiry in years
+        S: spot price
+        r: risk-free rate
+        kind: "ssvi" or "svi"
+        weights: optional (E, K) residual weights (e.g. vega), defaults to 1
+
+        Returns:
+        SVISurface
+        """
+        with get_metrics().timer("stage_seconds", stage="surface_fit"):
+            iv = np.asarray(iv, dtype=np.float64)
+            expiries = np.asarray(expiries, dtype=np.float64)
+            order = np.argsort(expiries)
+            iv, expiries = iv[order], expiries[order]
+            strikes = np.broadcast_to(np.asarray(strikes, dtype=np.float64), iv.shape)[order]
+            weights = np.ones(iv.shape) if weights is None else np.broadcast_to(np.asarray(weights, dtype=np.float64), iv.shape)[order]
+            k = np.log(strikes / (S * np.exp(r * expiries)[:, None]))
+            quoted = np.isfinite(iv) & np.isfinite(k) & (iv > 0)
+            slice_of = np.nonzero(quoted)[0]
+            k, vols, weights = k[quoted], iv[quoted], weights[quoted]
+            params = cls._fit_ssvi(k, vols, weights, slice_of, expiries)
+            if kind == "svi":
+                params = cls._fit_raw(k, vols, weights, slice_of, expiries, params)
+            elif kind != "ssvi":
+                raise ValueError(f"unknown kind {kind}")
+            return cls(expiries, params, S, r)
+
+    @staticmethod
+    def _fit_ssvi(k, vols, weights, slice_of, expiries):
+        from scipy.optimize import least_squares
+        num_expiries = expiries.size
+        t = expiries[slice_of]
+        w = vols * vols * t
+        # ATM total variance per slice from the quote closest to k = 0 as a starting point
+        theta0 = np.array([w[slice_of == e][np.argmin(np.abs(k[slice_of == e]))] if (slice_of == e).any() else np.nan for e in range(num_expiries)])
+        theta0 = np.maximum.accumulate(np.nan_to_num(theta0, nan=np.nanmin(theta0) if np.isfinite(theta0).any() else 0.04))
+        # theta is parametrized by non-negative increments so it can't decrease with T
+        x0 = np.concatenate(([-0.3, 0.5, 0.3], np.diff(theta0, prepend=0.0) + 1e-6))
+        lower = np.concatenate(([-0.999, 1e-4, 1e-3], np.zeros(num_expiries)))
+        upper = np.concatenate(([0.999, 4.0, 0.5], np.full(num_expiries, np.inf)))
+
+        def residuals(x):
+            rho, eta, gamma = x[:3]
+            theta = np.cumsum(x[3:])
+            theta = np.maximum(theta, 1e-10)
+            phi = power_law_phi(theta, eta, gamma)[slice_of]
+            model = theta[slice_of] / 2 * (1 + rho * phi * k + np.sqrt((phi * k + rho) ** 2 + 1 - rho * rho))
+            # butterfly condition eta (1 + |rho|) <= 2 as a stiff penalty
+            penalty = 1e3 * max(eta * (1 + abs(rho)) - 2, 0)
+            return np.append(weights * (np.sqrt(np.maximum(model, 0) / t) - vols), penalty)
+
+        x = least_squares(residuals, x0, bounds=(lower, upper), method="trf").x
+        theta = np.maximum(np.cumsum(x[3:]), 1e-10)
+        return ssvi_to_raw(theta, x[0], power_law_phi(theta, x[1], x[2]))
+
+    @staticmethod
+    def _fit_raw(k, vols, weights, slice_of, expiries, params):
+        from scipy.optimize import least_squares
+        from scipy.sparse import lil_matrix
+        num_expiries = params.shape[0]
+        num_quotes = k.size
+        t = expiries[slice_of]
+        lower = np.tile([-np.inf, 0.0, -0.999, -np.inf, 1e-4], num_expiries)
+        upper = np.tile([np.inf, np.inf, 0.999, np.inf, np.inf], num_expiries)
+        x0 = np.clip(params.ravel(), lower + 1e-9, upper - 1e-9)
+        # each quote only depends on its own slice, plus one non-negative minimum variance penalty per slice
+        sparsity = lil_matrix((num_quotes + num_expiries, x0.size), dtype=int)
+        for j in range(NUM_PARAMS):
+            sparsity[np.arange(num_quotes), slice_of * NUM_PARAMS + j] = 1
+            sparsity[num_quotes + np.arange(num_expiries), np.arange(num_expiries) * NUM_PARAMS + j] = 1
+
+        def residuals(x):
+            a, b, rho, m, sigma = x.reshape(num_expiries, NUM_PARAMS).T
+            model = raw_svi(k, a[slice_of], b[slice_of], rho[slice_of], m[slice_of], sigma[slice_of])[0]
+            min_variance = a + b * sigma * np.sqrt(1 - rho * rho)
+            return np.concatenate([weights * (np.sqrt(np.maximum(model, 0) / t) - vols), 1e3 * np.maximum(-min_variance, 0)])
+
+        x = least_squares(residuals, x0, bounds=(lower, upper), jac_sparsity=sparsity, method="trf").x
+        return x.reshape(num_expiries, NUM_PARAMS)
+
+    @classmethod
+    def from_chain(cls, chain, date: int, S: float, r: float=0, iv=None, kind: str="ssvi", min_quotes: int=5):
+        """
+        Fits the surface of one chain date from out-of-the-money quotes (puts below the forward, calls above)
+
+        Arguments:
+        chain: OptionChain with both rights
+        date: chain date (days since epoch)
+        S: spot on that date
+        iv: implied vols shaped like the chain's fields, defaults to bs_iv_chain on the mid
+        min_quotes: expiries with fewer quotes are left out
+        """
+        d = chain.date_index(date)
+        if iv is None:
+            iv = bs_iv_chain(chain.on_date(date), np.array([S]), r)[:, :, 0]
+        else:
+            iv = iv[:, :, d]
+        t = chain.time_to_expiry()[:, d]
+        forwards = S * np.exp(r * np.nan_to_num(t))
+        otm_call = chain.strikes[None, :] >= forwards[:, None]
+        calls, puts = iv[chain.right_index(Right.CALL)], iv[chain.right_index(Right.PUT)]
+        smiles = np.where(otm_call, calls, puts)
+        keep = (t > 0) & (np.isfinite(smiles).sum(axis=1) >= min_quotes)
+        return cls.fit(chain.strikes, smiles[keep], t[keep], S, r=r, kind=kind)
+
+    def _slices(self, k, T):
+        """
+        Total variance and its k-derivatives at (k, T), interpolated linearly in T between slices
+        """
+        k, T = np.broadcast_arrays(np.asarray(k, dtype=np.float64), np.asarray(T, dtype=np.float64))
+        hi = np.clip(np.searchsorted(self._t, T), 1, self._t.size - 1)
+        lo = hi - 1
+        weight = (T - self._t[lo]) / (self._t[hi] - self._t[lo])
+        w_lo = raw_svi(k, *np.moveaxis(self._params[lo], -1, 0))
+        w_hi = raw_svi(k, *np.moveaxis(self._params[hi], -1, 0))
+        # past the last expiry keep the last slice's implied vol
+        beyond = T > self._t[-1]
+        scale = np.where(beyond, T / self._t[-1], 1.0)
+        weight = np.where(beyond, 1.0, weight)
+        return tuple(scale * ((1 - weight) * low + weight * high) for low, high in zip(w_lo, w_hi))
+
+    def log_moneyness(self, K, T):
+        return np.log(np.asarray(K, dtype=np.float64) / (self.S * np.exp(self.r * np.asarray(T, dtype=np.float64))))
+
+    def total_variance(self, K, T):
+        return self._slices(self.log_moneyness(K, T), T)[0]
+
+    def iv(self, K, T):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(self.total_variance(K, T) / T)
+
+    def price(self, K, T, rights=None):
+        """
+        Black-Scholes prices off the surface, rights as in black_scholes.rights_to_mask (defaults to calls)
+        """
+        return bs_price(self.S, K, self.iv(K, T), T, self.r, rights=rights)
+
+    def density(self, K, T):
+        """
+        Risk-neutral density of the underlying at expiry T, from the slice's g(k):
+        p(K) = g(k) / (K sqrt(2 pi w)) exp(-d2^2 / 2) with d2 = -k / sqrt(w) - sqrt(w) / 2
+        """
+        k = self.log_moneyness(K, T)
+        w, dw, d2w = self._slices(k, T)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            root_w = np.sqrt(w)
+            d2 = -k / root_w - root_w / 2
+            return butterfly_g(k, w, dw, d2w) * np.exp(-d2 * d2 / 2) / (np.asarray(K, dtype=np.float64) * root_w * np.sqrt(2 * np.pi))
+
+    def check_arbitrage(self, k=None, tol: float=1e-10) -> dict:
+        """
+        Butterfly (g(k) >= 0 on every slice) and calendar (total variance non-decreasing in T at every k) checks
+
+        Arguments:
+        k: log-moneyness grid to check on, defaults to np.linspace(-1.5, 1.5, 601)
+
+        Returns:
+        dict with butterfly (E,) and calendar (E - 1,) booleans (True where free of arbitrage), min_g per slice and
+        min_calendar_spread per consecutive pair
+        """
+        k = np.linspace(-1.5, 1.5, 601) if k is None else np.asarray(k, dtype=np.float64)
+        w, dw, d2w = raw_svi(k[None, :], *(self.params.T[:, :, None]))
+        min_g = butterfly_g(k[None, :], w, dw, d2w).min(axis=1)
+        min_spread = np.diff(w, axis=0).min(axis=1)
+        return {
+            "butterfly": min_g >= -tol,
+            "calendar": min_spread >= -tol,
+            "min_g": min_g,
+            "min_calendar_spread": min_spread,
+            "arbitrage_free": bool((min_g >= -tol).all() and (min_spread >= -tol).all() and (w > 0).all()),
+        }
@@ -0,0 +1,153 @@
+import os
+import json
+import logging
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from engine import Engine, to_days
+from dates import datetime_to_days
+from model import Model
+from model_store import ModelStore
+from market_data import MarketDataStore, get_store
+from distribution import vix_regimes
+from black_scholes import rights_to_mask
+
+logger = logging.getLogger(__name__)
+
+QUOTE_DTYPE = np.dtype([("date", "<i8"), ("exp", "<i8"), ("strike", "<f8"), ("is_call", "?"), ("bid", "<f8"), ("ask", "<f8")])
+
+DEFAULT_CONFIG = {
+    "bandwidth": None,          # kernel bandwidth, None for Scott's rule or "cv"
+    "regime": "base",           # "base" for one KDE, "vix" for one KDE per VIX regime
+    "regime_edges": [8, 24, 40],
+    "min_regime_samples": 30,   # regimes with fewer returns fall back to the base KDE
+    "lookback_days": 3650,      # calendar days of returns before each trade date
+    "edge": 0.0,                # theo has to clear the ask (bid) by this much to go long (short)
+}
+
+def save_quotes(quotes: pd.DataFrame, path: str) -> str:
+    """
+    Writes the quotes a sweep trades on (columns date, exp, strike, right, bid, ask) to a .npy file that every worker
+    memory-maps instead of receiving its own copy
+    """
+    data = np.empty(len(quotes), dtype=QUOTE_DTYPE)
+    data["date"] = to_days(quotes["date"])
+    data["exp"] = to_days(quotes["exp"])
+    data["strike"] = quotes["strike"].to_numpy(dtype=np.float64)
+    data["is_call"] = rights_to_mask(quotes["right"].to_numpy(), len(quotes))
+    data["bid"] = quotes["bid"].to_numpy(dtype=np.float64)
+    data["ask"] = quotes["ask"].to_numpy(dtype=np.float64)
+    np.save(path, np.sort(data, order="date"))
+    return path
+
+def config_id(config: dict) -> str:
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+def run_config(config: dict, root: str, quotes_path: str, data_dir: str) -> dict:
+    """
+    Backtests one configuration of the KDE signal on the saved quotes, refitting the density every trade date on the
+    returns strictly before it.
+
+    Returns:
+    dict of the config, total PnL, trade count and PnL/hit rate per (right, direction) bucket
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    quotes = np.load(quotes_path, mmap_mode="r")
+    market_data = MarketDataStore(data_dir, offline=True)
+    closes = market_data.closes(root)
+    returns = np.log(closes/closes.shift(1)).dropna()
+    return_days = datetime_to_days(returns.index)
+    store = ModelStore(persist=False)
+    engine = Engine(root, closes.index[0].date(), market_data=market_data)
+
+    trade_days, starts = np.unique(quotes["date"], return_index=True)
+    ends = np.append(starts[1:], quotes.size)
+    if config["regime"] == "vix":
+        vix = market_data.closes("^VIX")
+        # regime of a return is set by the VIX close the day before, a trade date's by that day's close
+        return_regimes = vix_regimes(returns, vix=vix, edges=config["regime_edges"], lag=1).to_numpy()
+        trade_index = pd.DatetimeIndex(trade_days.astype("datetime64[D]"))
+        trade_regimes = vix_regimes(pd.Series(0, index=trade_index), vix=vix, edges=config["regime_edges"]).to_numpy()
+    signals = []
+    for i, (day, start, end) in enumerate(zip(trade_days, starts, ends)):
+        lo = np.searchsorted(return_days, day - config["lookback_days"])
+        hi = np.searchsorted(return_days, day)
+        window = returns.iloc[lo:hi]
+        regime = None
+        if config["regime"] == "vix":
+            regime = int(trade_regimes[i])
+            in_regime = return_regimes[lo:hi] == regime
+            if in_regime.sum() >= config["min_regime_samples"]:
+                window = window[in_regime]
+            else:
+                regime = None
+        if window.size < 2:
+            continue
+        model = Model.from_fitted(store.fit(root=root, returns=window, bandwidth=config["bandwidth"], regime=regime))
+        spot_index = engine.spot_index(np.array([day]))[0]
+        day_quotes = quotes[start:end]
+        theos = model.theos(strikes=day_quotes["strike"], spot=engine.spot_values[spot_index], rights=day_quotes["is_call"])
+        direction = (theos > day_quotes["ask"] + config["edge"]).astype(int) - (theos < day_quotes["bid"] - config["edge"]).astype(int)
+        traded = direction != 0
+        signals.append(pd.DataFrame({
+            "date": day_quotes["date"][traded].astype("datetime64[D]"),
+            "exp": day_quotes["exp"][traded].astype("datetime64[D]"),
+            "strike": day_quotes["strike"][traded],
+            "right": np.where(day_quotes["is_call"][traded], "C", "P"),
+            "direction": direction[traded],
+            "entry": np.where(direction[traded] == 1, day_quotes["ask"][traded], day_quotes["bid"][traded]),
+            "theo": theos[traded],
+        }))
+
+    result = {"config_id": config_id(config), **{k: json.dumps(v) for k, v in config.items()}}
+    results = engine.run(pd.concat(signals, ignore_index=True)) if signals else engine.run(pd.DataFrame(columns=["exp", "strike", "right", "direction", "entry"]))
+    result["trades"] = len(results)
+    result["pnl"] = float(results["pnl"].sum())
+    stats = Engine.stats(results)
+    for right, name in (("C", "calls"), ("P", "puts")):
+        for direction, side in ((1, "long"), (-1, "short")):
+            row = stats.loc[(right, direction)] if (right, direction) in stats.index else None
+            result[f"{name}_{side}_trades"] = 0 if row is None else int(row["trades"])
+            result[f"{name}_{side}_pnl"] = 0.0 if row is None else float(row["pnl"])
+            result[f"{name}_{side}_hit_rate"] = np.nan if row is None else float(row["hit_rate"])
+    return result
+
+def run_sweep(configs: list[dict], root: str, quotes_path: str, results_path: str, num_workers: int=None, data_dir: str=None) -> pd.DataFrame:
+    """
+    Runs every configuration over a process pool and collects one comparison table.
+
+    Each finished run is appended to results_path right away, and configurations already in it are skipped, so an
+    interrupted sweep picks up where it stopped. A configuration that raises is logged with its config_id and left out,
+    so it is retried on the next call. Closes for root and ^VIX are brought up to date once here; workers
+    read them (and the quotes) through memory maps.
+
+    Arguments:
+    configs: overrides of DEFAULT_CONFIG, one per run
+    root: underlying ticker
+    quotes_path: file written by save_quotes
+    results_path: CSV the results are appended to
+    num_workers: process count, defaults to os.cpu_count()
+    data_dir: MarketDataStore directory, defaults to the shared store's
+
+    Returns:
+    pd.DataFrame of all results (including earlier runs) sorted by PnL
+    """
+    market_data = get_store() if data_dir is None else MarketDataStore(data_dir)
+    for symbol in (root, "^VIX"):
+        market_data.closes(symbol)
+    done = set(pd.read_csv(results_path)["config_id"]) if os.path.exists(results_path) else set()
+    pending = [config for config in configs if config_id({**DEFAULT_CONFIG, **config}) not in done]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(run_config, config, root, quotes_path, market_data.data_dir): config_id({**DEFAULT_CONFIG, **config}) for config in pending}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("sweep config %s failed", futures[future])
+                continue
+            pd.DataFrame([result]).to_csv(results_path, mode="a", header=not os.path.exists(results_path), index=False)
+    if not os.path.exists(results_path):
+        return pd.DataFrame(columns=["config_id", "pnl"])
+    return pd.read_csv(results_path).sort_values("pnl", ascending=False, ignore_index=True)